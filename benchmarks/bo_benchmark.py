@@ -0,0 +1,76 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Compares suggestion latency and regret of the exact and sparse GP backends of BO_optimizer on a synthetic objective.
+# Run from the repository root:  python -m benchmarks.bo_benchmark --sizes 100 1000 10000 --exact-max 10000
+
+import argparse
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from bo import BO_optimizer
+
+def objective(X, center=0.3):
+    '''
+    Synthetic loss with ripples on [0,1]^N whose minimum of 0 is at x = center in every dimension.
+    '''
+    return np.sum((X - center) ** 2 + 0.05 * (1 - np.cos(8 * np.pi * (X - center))), axis=1)
+
+def synthetic_data(M, N, seed=0, noise=0.01):
+    '''
+    Builds a parameter dataframe in the layout expected by BO_optimizer with M random, normalized conditions of N parameters.
+    '''
+    rng = np.random.default_rng(seed)
+    X = rng.random((M, N))
+    data = pd.DataFrame({'Image': [f'im_{m}' for m in range(M)], 'Failed': False})
+    for n in range(N):
+        data[f'Param{n + 1}'] = X[:, n]
+    data['ImageArray'] = None
+    data['TotalLoss'] = objective(X) + noise * rng.normal(size=M)
+    return data
+
+def run(sizes, N, batch_size, num_inducing, exact_max, seed):
+    '''
+    Times one BO_optimizer suggestion per backend and data size, and computes the simple regret of the best suggestion.
+    '''
+    rows = []
+    param_path = tempfile.mkdtemp() + '/data.csv'
+    for M in sizes:
+        data = synthetic_data(M, N, seed)
+        for model_type in ['GP', 'sparseGP']:
+            if model_type == 'GP' and M > exact_max:
+                continue
+            np.random.seed(seed)
+            start = time.perf_counter()
+            predicted = BO_optimizer(data=data, batch_size=batch_size, param_path=param_path, save=False,
+                                     model_type=model_type, num_inducing=num_inducing)
+            latency = time.perf_counter() - start
+            regret = np.min(objective(predicted.iloc[:, 1:].values.astype(float)))
+            rows.append({'M': M, 'model_type': model_type, 'latency_s': latency, 'regret': regret})
+            print(rows[-1], flush=True)
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares suggestion latency and regret of the exact and sparse GP backends.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='numbers of imaged conditions M')
+    parser.add_argument('--params', type=int, default=3, help='number of control parameters N')
+    parser.add_argument('--batch-size', type=int, default=1, help='BO batch size')
+    parser.add_argument('--num-inducing', type=int, default=100, help='inducing points of the sparse GP')
+    parser.add_argument('--exact-max', type=int, default=1000, help='largest M to run the exact GP on')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(run(args.sizes, args.params, args.batch_size, args.num_inducing, args.exact_max, args.seed).to_string(index=False))
@@ -0,0 +1,80 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Times the start of fresh Python processes that import each entry point, reporting the import time, the total process
+# start time, and which heavy dependencies each entry point pulls in, so regressions of the worker start time are caught.
+# Run from the repository root:  python -m benchmarks.import_benchmark
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+HEAVY_MODULES = ['matplotlib', 'pandas', 'GPy', 'GPyOpt', 'scipy.signal', 'scipy.sparse']
+ENTRY_POINTS = {
+    'pipeline (CV-only worker)': 'import pipeline',
+    'segmentation': 'import segmentation',
+    'loss': 'import loss',
+    'video': 'import video',
+    'sweep': 'import sweep',
+    'diagnostics': 'import diagnostics',
+    'bo': 'import bo',
+    'previous worker imports': 'import matplotlib.pyplot, scipy.signal, scipy.sparse.csgraph, pipeline', # before plotting moved to diagnostics.py
+}
+
+def import_time(statement, repeats):
+    '''
+    Runs an import statement in fresh Python processes.
+
+    Inputs:
+    statement     := import statement
+    repeats       := number of processes; the median times are reported
+
+    Outputs:
+    import_s      := median time of the import statement in seconds
+    process_s     := median time from starting the process to its exit in seconds
+    heavy         := heavy modules loaded by the statement, see HEAVY_MODULES
+    '''
+    script = ('import sys, time\nstart = time.perf_counter()\n' + statement + '\n'
+              'print(time.perf_counter() - start)\n'
+              f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    import_s, process_s = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True, check=True)
+        process_s.append(time.perf_counter() - start)
+        lines = output.stdout.splitlines()
+        import_s.append(float(lines[-2]))
+    return np.median(import_s), np.median(process_s), lines[-1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the import time of every entry point in fresh processes.')
+    parser.add_argument('--repeats', type=int, default=5, help='processes per entry point, the median is reported')
+    parser.add_argument('--csv', default=None, help='path to save the results as csv')
+    args = parser.parse_args()
+    rows = []
+    for name, statement in ENTRY_POINTS.items():
+        import_s, process_s, heavy = import_time(statement, args.repeats)
+        rows.append({'entry_point': name, 'import_s': import_s, 'process_s': process_s, 'heavy_modules': heavy})
+    results = pd.DataFrame(rows)
+    pd.set_option('display.width', 200)
+    print(results.to_string(index=False))
+    if args.csv is not None:
+        results.to_csv(args.csv, index=False)
@@ -0,0 +1,179 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Times every stage of the crop -> segment -> loss -> BO chain on synthetic droplet images and scores the segmentation
+# against the known droplet geometry, so speed and correctness regressions can be checked offline.
+# Run from the repository root:  python -m benchmarks.pipeline_benchmark --csv results.csv
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+import cv2 # pip install opencv-python          # https://pypi.org/project/opencv-python/
+import numpy as np
+import pandas as pd
+from crop import read_rotate_crop
+from segmentation import watershed_segment, watershed_segment_tiled
+from loss import yield_loss, geometric_loss
+from bo import BO_optimizer
+from benchmarks.synthetic import droplet_tube, droplet_frame
+from benchmarks.bo_benchmark import synthetic_data, objective
+
+ROTATE_CROP_PARAMS = {'theta': 0.5, 'x1': 920, 'x2': 1080, 'y1': 10} # crop window of the example notebook, 'y2' is set per image height
+
+def measure(function, repeats=1):
+    '''
+    Runs a function and measures its wall time and peak allocated memory.
+
+    Inputs:
+    function      := function without arguments
+    repeats       := number of runs; the fastest wall time is reported
+
+    Outputs:
+    result        := return value of the last run
+    wall_s        := fastest wall time in seconds
+    peak_mb       := largest peak traced memory in MB
+    '''
+    wall, peak = np.inf, 0
+    for _ in range(repeats):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function()
+        wall = min(wall, time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] / 1e6)
+        tracemalloc.stop()
+    return result, wall, peak
+
+def segmentation_accuracy(droplet_geometry, truth):
+    '''
+    Scores the segmented droplets against the synthetic ground truth.
+
+    Inputs:
+    droplet_geometry  := droplet geometry list returned by geometric_loss
+    truth             := ground truth dataframe returned by droplet_tube
+
+    Outputs:
+    accuracy          := dictionary of values: {detected, true, recall, radius_error}, where recall is the fraction of true
+                         droplets with a detected centroid inside them, and radius_error is the mean absolute error of
+                         the half chord lengths of those droplets in pixels
+    '''
+    detected = np.array([geometry[2:6] for geometry in droplet_geometry], dtype=float).reshape(-1, 4)
+    errors = []
+    for droplet in truth.itertuples():
+        if not len(detected):
+            break
+        distance = np.hypot(detected[:, 0] - droplet.centroid_x, detected[:, 1] - droplet.centroid_y)
+        nearest = np.argmin(distance)
+        if distance[nearest] <= min(droplet.radius_x, droplet.radius_y):
+            errors.append((abs(detected[nearest, 2] / 2 - droplet.radius_x) + abs(detected[nearest, 3] / 2 - droplet.radius_y)) / 2)
+    return {'detected': len(detected), 'true': len(truth), 'recall': len(errors) / max(len(truth), 1),
+            'radius_error': np.mean(errors) if errors else np.nan}
+
+def fitting_radius(height, width, num_droplets, deformation):
+    '''
+    Returns the largest droplet radius, up to a quarter of the tube width, for which droplet_tube can place all droplets.
+    '''
+    radius = width / 4
+    while radius > 2:
+        cell = int(np.ceil(2 * radius * 1.2 * (1 + deformation))) + 6  # same grid as droplet_tube
+        if max(width // cell, 1) * max(height // cell, 1) >= num_droplets:
+            break
+        radius -= 0.5
+    return radius
+
+def benchmark_crop(heights, frame_shape, repeats):
+    '''
+    Times read_rotate_crop on synthetic camera frames, with and without "roi_only".
+    '''
+    rows = []
+    folder = tempfile.mkdtemp()
+    for height in heights:
+        params = dict(ROTATE_CROP_PARAMS, y2=ROTATE_CROP_PARAMS['y1'] + height)
+        tube, _ = droplet_tube(height, params['x2'] - params['x1'], height // 30, 10)
+        path = os.path.join(folder, f'frame_{height}.png')
+        cv2.imwrite(path, droplet_frame(tube, params, (max(frame_shape[0], height + 20), frame_shape[1])))
+        for roi_only in [False, True]:
+            _, wall, peak = measure(lambda: read_rotate_crop(path, params, roi_only=roi_only), repeats)
+            rows.append({'stage': 'read_rotate_crop', 'variant': f'roi_only={roi_only}', 'height': height,
+                         'wall_s': wall, 'peak_mb': peak})
+    return rows
+
+def benchmark_segmentation(heights, droplet_counts, repeats, tile_size=256):
+    '''
+    Times watershed_segment, yield_loss, and geometric_loss on synthetic droplet tubes and scores their accuracy, and
+    checks that watershed_segment_tiled with tiles of "tile_size" pixels matches watershed_segment.
+    '''
+    rows = []
+    for height in heights:
+        for num_droplets in droplet_counts:
+            radius = fitting_radius(height, 160, num_droplets, deformation=0.1)
+            for double_watershed, style in [(False, 'solid'), (True, 'ring')]:
+                image, truth = droplet_tube(height, 160, num_droplets, radius, deformation=0.1, style=style)
+                for remove_artefacting in ([False, True] if double_watershed else [False]):
+                    droplet_count, wall, peak = measure(lambda: watershed_segment(
+                        image=image, double_watershed=double_watershed, large_elements_pixels=5000, pixel_diff=500,
+                        drop_dilate=5, plot_pixel_diff=False, remove_artefacting=remove_artefacting), repeats)
+                    case = {'height': height, 'droplets': len(truth),
+                            'variant': f'double_watershed={double_watershed}, remove_artefacting={remove_artefacting}'}
+                    rows.append(dict(case, stage='watershed_segment', wall_s=wall, peak_mb=peak))
+                    yld_loss, wall, peak = measure(lambda: yield_loss(droplet_count, max_droplets=len(truth)), repeats)
+                    rows.append(dict(case, stage='yield_loss', wall_s=wall, peak_mb=peak, loss=yld_loss))
+                    (geom_loss, droplet_geometry), wall, peak = measure(
+                        lambda: geometric_loss(droplet_count, image_name='synthetic', iter_plot=False), repeats)
+                    rows.append(dict(case, stage='geometric_loss', wall_s=wall, peak_mb=peak, loss=geom_loss,
+                                     **segmentation_accuracy(droplet_geometry, truth)))
+                    tiled, wall, peak = measure(lambda: watershed_segment_tiled(
+                        image=image, double_watershed=double_watershed, large_elements_pixels=5000, pixel_diff=500,
+                        drop_dilate=5, plot_pixel_diff=False, remove_artefacting=remove_artefacting,
+                        tile_size=tile_size, halo=int(2 * radius * 1.1) + 8), repeats)
+                    rows.append(dict(case, stage='watershed_segment_tiled', wall_s=wall, peak_mb=peak,
+                                     matches_whole_frame=np.array_equal(tiled, droplet_count)))
+    return rows
+
+def benchmark_bo(dataset_sizes, batch_size):
+    '''
+    Times BO_optimizer on synthetic parameter data of increasing size and reports the regret of its suggestions.
+    '''
+    rows = []
+    param_path = tempfile.mkdtemp() + '/data.csv'
+    for M in dataset_sizes:
+        data = synthetic_data(M, 3)
+        np.random.seed(0)
+        predicted, wall, peak = measure(lambda: BO_optimizer(data=data, batch_size=batch_size,
+                                                             param_path=param_path, save=False))
+        rows.append({'stage': 'BO_optimizer', 'variant': f'batch_size={batch_size}', 'images': M, 'wall_s': wall,
+                     'peak_mb': peak, 'regret': np.min(objective(predicted.iloc[:, 1:].values.astype(float)))})
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the speed and accuracy of every stage on synthetic droplet images.')
+    parser.add_argument('--heights', type=int, nargs='+', default=[750, 1490, 3000], help='cropped image heights in pixels')
+    parser.add_argument('--droplets', type=int, nargs='+', default=[30, 100, 200], help='droplets per image')
+    parser.add_argument('--images', type=int, nargs='+', default=[20, 60, 200], help='BO dataset sizes')
+    parser.add_argument('--frame', type=int, nargs=2, default=[2048, 2448], help='camera frame height and width')
+    parser.add_argument('--tile-size', type=int, default=256, help='tile size of tiled segmentation')
+    parser.add_argument('--batch-size', type=int, default=1, help='BO batch size')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per measurement, the fastest is reported')
+    parser.add_argument('--csv', default=None, help='path to save the results as csv')
+    args = parser.parse_args()
+    results = pd.DataFrame(benchmark_crop(args.heights, args.frame, args.repeats)
+                           + benchmark_segmentation(args.heights, args.droplets, args.repeats, args.tile_size)
+                           + benchmark_bo(args.images, args.batch_size))
+    pd.set_option('display.width', 200)
+    print(results.to_string(index=False))
+    if args.csv is not None:
+        results.to_csv(args.csv, index=False)
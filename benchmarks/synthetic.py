@@ -0,0 +1,80 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import cv2 # pip install opencv-python          # https://pypi.org/project/opencv-python/
+import numpy as np
+import pandas as pd
+
+def droplet_tube(height, width, num_droplets, radius, deformation=0., noise=5., style='solid', seed=0):
+    '''
+    Renders a deterministic synthetic image of a tube of droplets with known geometry.
+
+    Inputs:
+    height, width     := image size in pixels
+    num_droplets      := number of droplets to place. Fewer are placed if the tube is full.
+    radius            := mean droplet radius in pixels; each droplet radius varies uniformly by +/- 20%
+    deformation       := maximum relative difference between the x and y radii of each droplet, 0 for circles
+    noise             := standard deviation of the added gaussian pixel noise
+    style             := 'solid' for dark droplets on a light background (one-fold watershed) or
+                         'ring' for droplets with a dark border shadow and a bright interior (two-fold watershed)
+    seed              := random seed
+
+    Outputs:
+    image             := RGB uint8 image (height by width by 3)
+    truth             := dataframe of the ['centroid_x', 'centroid_y', 'radius_x', 'radius_y'] of every placed droplet
+    '''
+    rng = np.random.default_rng(seed)
+    background, border, interior = (210, 40, 40) if style == 'solid' else (60, 30, 235)
+    image = np.full((height, width), background, dtype=np.uint8)
+    cell = int(np.ceil(2 * radius * 1.2 * (1 + deformation))) + 6  # droplets are placed on a grid of non-overlapping cells
+    cols, rows = max(width // cell, 1), max(height // cell, 1)
+    cells = rng.permutation(rows * cols)[:num_droplets]
+    truth = []
+    for c in np.sort(cells):
+        r = radius * rng.uniform(0.8, 1.2)
+        radius_x, radius_y = r * (1 + deformation * rng.uniform(-1, 1) / 2), r * (1 + deformation * rng.uniform(-1, 1) / 2)
+        slack_x, slack_y = max(cell - 2 * radius_x - 6, 0) / 2, max(cell - 2 * radius_y - 6, 0) / 2
+        centroid_x = (c % cols) * cell + cell / 2 + rng.uniform(-slack_x, slack_x)
+        centroid_y = (c // cols) * cell + cell / 2 + rng.uniform(-slack_y, slack_y)
+        axes = (int(round(radius_x)), int(round(radius_y)))
+        center = (int(round(centroid_x)), int(round(centroid_y)))
+        cv2.ellipse(image, center, axes, 0, 0, 360, border, -1)
+        if style == 'ring':
+            cv2.ellipse(image, center, (max(axes[0] * 3 // 4, 1), max(axes[1] * 3 // 4, 1)), 0, 0, 360, interior, -1)
+        truth.append([center[0], center[1], axes[0], axes[1]])
+    image = np.clip(image + rng.normal(0, noise, image.shape), 0, 255).astype(np.uint8)
+    truth = pd.DataFrame(truth, columns=['centroid_x', 'centroid_y', 'radius_x', 'radius_y'])
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB), truth
+
+def droplet_frame(tube, rotate_crop_params, frame_shape):
+    '''
+    Embeds a droplet tube image into a larger camera frame at the crop window of "rotate_crop_params", rotated so that
+    read_rotate_crop approximately recovers the tube.
+
+    Inputs:
+    tube                 := droplet tube image, see droplet_tube
+    rotate_crop_params   := dictionary of values: {theta, x1, x2, y1, y2}, see read_rotate_crop
+    frame_shape          := (height, width) of the camera frame
+
+    Outputs:
+    frame                := RGB uint8 camera frame
+    '''
+    frame = np.full(tuple(frame_shape) + (3,), int(np.median(tube)), dtype=np.uint8)
+    y1, x1 = rotate_crop_params['y1'], rotate_crop_params['x1']
+    frame[y1:y1 + tube.shape[0], x1:x1 + tube.shape[1]] = tube[:frame_shape[0] - y1, :frame_shape[1] - x1]
+    center = (frame_shape[1] / 2, frame_shape[0] / 2)
+    rotation = cv2.getRotationMatrix2D(center, -rotate_crop_params['theta'], 1.)
+    return cv2.warpAffine(frame, rotation, (frame_shape[1], frame_shape[0]), borderMode=cv2.BORDER_REPLICATE)
@@ -20,8 +20,11 @@ import os
 import GPy
 import GPyOpt # Developed using GPyOpt version 1.2.6
 from GPyOpt.methods import BayesianOptimization
+from instrument import stage, timed
 
-def BO_optimizer(data, batch_size, param_path, save):
+@timed('BO_optimizer')
+def BO_optimizer(data, batch_size, param_path, save, warm_start=False, model_type='GP', num_inducing=100,
+                 noise_var=None):
     '''
     Implement Bayesian optimization.
 
@@ -32,6 +35,16 @@ def BO_optimizer(data, batch_size, param_path, save):
                      Losses are computed using the computer vision-based loss score in loss.py
     batch_size    := desired output batch size B for the suggested next locations
     save          := True or False value; saves predicted parameters for B samples as csv at the specified "param_path"
+    warm_start    := True or False value; saves the fitted GP state (kernel hyperparameters, noise variance, X and Y data)
+                     as "bo_state.npz" at the specified "param_path". The next call starts the hyperparameter optimization
+                     from the saved state with a single restart, as long as the previous data are unchanged and only new
+                     observations were appended. Otherwise, the GP is refit from default initial values.
+    model_type    := 'GP' or 'sparseGP'; the exact GP costs O(M^3) to fit, while the sparse GP approximates it with fixed
+                     "num_inducing" inducing inputs at O(M * num_inducing^2), for campaigns with thousands of images
+    num_inducing  := number of inducing points of the sparse GP; ignored if model_type is 'GP'
+    noise_var     := variance of the observation noise of the total losses, e.g., the mean variance of the loss of each
+                     condition averaged over video frames, see video.py. If given, the GP noise variance is fixed to it
+                     instead of being fit. If None, the noise variance is fit with the kernel hyperparameters.
 
     Ouputs:
     df            := A dataframe of predicted, normalized parameter values (B by N), where N are the control parameters and B is the batch size
@@ -43,10 +56,22 @@ def BO_optimizer(data, batch_size, param_path, save):
 
     kernel = GPy.kern.Matern52(input_dim=len(bds),
                                ARD=True)  # Use the matern 5/2 kernel with automatic relevence detection enabled
+    state_path = os.path.dirname(param_path) + '/bo_state.npz'
+    state = load_state(state_path, X, Y) if warm_start else None
+    if model_type == 'GP':
+        model_kwargs = {}
+    elif model_type == 'sparseGP':
+        model_kwargs = {'num_inducing': min(num_inducing, X.shape[0])}
+    else:
+        raise ValueError("Argument 'model_type' takes value either 'GP' or 'sparseGP'.")
+    if state is not None:  # warm start from the hyperparameters fit on the previous data
+        kernel.variance = state['variance']
+        kernel.lengthscale = state['lengthscale']
+        model_kwargs.update({'noise_var': state['noise_var'].item(), 'optimize_restarts': 1})
     optimizer = BayesianOptimization(f=None,
                                      domain=bds,
                                      constraints=None,
-                                     model_type='GP',  # gaussian process model
+                                     model_type=model_type,  # exact or sparse gaussian process model
                                      acquisition_type='EI',  # expected improvement acquisition
                                      acquisition_jitter=0.01,  # tune to adjust exploration
                                      X=X,  # normalized parameter value data
@@ -54,13 +79,83 @@ def BO_optimizer(data, batch_size, param_path, save):
                                      evaluator_type='local_penalization',
                                      batch_size=batch_size,  # batch size of predicted optima
                                      normalize_Y=False,
-                                     kernel=kernel  # select the kernel
+                                     kernel=kernel,  # select the kernel
+                                     **model_kwargs
                                      )
-    predicted = optimizer.suggest_next_locations()  # get next parameter values to synthesize experimentally
+    if model_type == 'sparseGP' or noise_var is not None:  # create the GP up front to constrain its parameters
+        optimizer.model._create_model(X, Y.reshape(Y.shape[0], 1))
+    if model_type == 'sparseGP':  # only the hyperparameters of the sparse GP are optimized
+        sparse_model = optimizer.model.model
+        sparse_model.inducing_inputs = inducing_inputs(X, Y, model_kwargs['num_inducing'])
+        sparse_model.inducing_inputs.fix()
+        if state is not None:
+            sparse_model.Gaussian_noise.variance = state['noise_var']
+    if noise_var is not None:
+        optimizer.model.model.Gaussian_noise.variance.fix(noise_var)  # the measured noise is not refit
+    with stage('gp_fit_suggest', images=X.shape[0]):
+        predicted = optimizer.suggest_next_locations()  # get next parameter values to synthesize experimentally
+    if warm_start:
+        save_state(state_path, optimizer.model.model, X, Y)
     names = np.array([f'predicted_{p + 1}' for p in range(predicted.shape[0])])
     names = names.reshape(names.shape[0], 1)
     df = pd.DataFrame(np.concatenate((names, predicted), axis=1),
                       columns=['Prediction'] + [f'Param{n + 1}' for n in range(N)])
     if save:
-        df.to_csv(os.path.dirname(param_path) + '/bo_predicted_params.csv', sep=',', index=False)
+        predicted_path = os.path.dirname(param_path) + '/bo_predicted_params.csv'
+        df.to_csv(predicted_path + '.tmp', sep=',', index=False)
+        os.replace(predicted_path + '.tmp', predicted_path)  # atomic, so readers never see a partially written file
     return df
+
+def inducing_inputs(X, Y, num_inducing):
+    '''
+    Selects the inducing inputs of the sparse GP: half at the lowest loss conditions, to resolve the surrogate near the
+    optimum, and half at random among the remaining conditions, to cover the rest of the parameter space.
+
+    Inputs:
+    X             := parameter data (M by N)
+    Y             := total loss data (M)
+    num_inducing  := number of inducing inputs, at most M
+
+    Ouputs:
+    Z             := inducing inputs (num_inducing by N)
+    '''
+    order = np.argsort(Y)
+    best = order[:num_inducing // 2]
+    rest = np.random.permutation(order[num_inducing // 2:])[:num_inducing - len(best)]
+    return X[np.concatenate((best, rest))].copy()
+
+def load_state(state_path, X, Y):
+    '''
+    Loads the GP state saved by a previous BO_optimizer call.
+
+    Inputs:
+    state_path    := path of the saved state
+    X             := current parameter data (M by N)
+    Y             := current total loss data (M)
+
+    Ouputs:
+    state         := dictionary of values: {variance, lengthscale, noise_var, X, Y}, or None if there is no saved state
+                     or the saved X and Y data are not the first rows of the current data
+    '''
+    if not os.path.exists(state_path):
+        return None
+    with np.load(state_path) as f:
+        state = dict(f)
+    M = state['X'].shape[0]
+    if (state['X'].shape[1] != X.shape[1] or M > X.shape[0] or not np.array_equal(state['X'], X[:M])
+            or not np.array_equal(state['Y'], Y[:M])):
+        return None
+    return state
+
+def save_state(state_path, model, X, Y):
+    '''
+    Saves the fitted GP state for warm starting the next BO_optimizer call.
+
+    Inputs:
+    state_path    := path to save the state
+    model         := fitted GPy regression model
+    X             := parameter data (M by N) the model was fit on
+    Y             := total loss data (M) the model was fit on
+    '''
+    np.savez(state_path, variance=np.array(model.kern.variance), lengthscale=np.array(model.kern.lengthscale),
+             noise_var=np.array(model.Gaussian_noise.variance), X=X, Y=Y)
@@ -0,0 +1,113 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import numpy as np
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+# parameters that change a full resolution result. Others, e.g., {coarse} or {tile_size, halo}, only change how the
+# result is computed, so changing them keeps the cached results.
+KEY_PARAMS = ['rotate_crop_params', 'roi_only', 'double_watershed', 'large_elements_pixels', 'pixel_diff', 'drop_dilate',
+              'remove_artefacting', 'max_droplets']
+
+def cache_key(img_path, params):
+    '''
+    Computes the content-addressed cache key of a droplet image and its processing parameters.
+
+    Inputs:
+    img_path      := image path
+    params        := dictionary of crop, segmentation, and loss parameters, see pipeline.process_image
+
+    Outputs:
+    key           := hex digest of the image file contents and the exact values of the parameters in KEY_PARAMS
+    '''
+    digest = hashlib.sha256()
+    with open(img_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    key_params = {name: params.get(name) for name in KEY_PARAMS}
+    key_params['roi_only'] = params.get('roi_only', False)  # an omitted roi_only crops like an explicit False
+    digest.update(json.dumps(key_params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+def load_result(cache_dir, key):
+    '''
+    Loads a cached segmentation and loss result and marks it as recently used.
+
+    Inputs:
+    cache_dir     := directory of the cache
+    key           := cache key, see cache_key
+
+    Outputs:
+    entry         := dictionary of values: {droplet_count, yield_loss, geom_loss, total_loss, droplet_geometry},
+                     or None if the key is not cached
+    '''
+    path = os.path.join(cache_dir, key + '.pkl')
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+        os.utime(path)  # the modification time orders entries for least recently used eviction
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    return entry
+
+def save_result(cache_dir, key, entry, max_bytes=None):
+    '''
+    Saves a segmentation and loss result to the cache, then evicts the least recently used entries if the cache is too large.
+
+    Inputs:
+    cache_dir     := directory of the cache
+    key           := cache key, see cache_key
+    entry         := dictionary of values: {droplet_count, yield_loss, geom_loss, total_loss, droplet_geometry}
+    max_bytes     := maximum total size of the cache in bytes. If None, entries are never evicted.
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = dict(entry, droplet_count=np.asarray(entry['droplet_count']))
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, os.path.join(cache_dir, key + '.pkl'))  # atomic, so concurrent workers never read partial entries
+    if max_bytes is not None:
+        evict(cache_dir, max_bytes)
+
+def evict(cache_dir, max_bytes):
+    '''
+    Removes the least recently used cache entries until the cache is no larger than max_bytes.
+
+    Inputs:
+    cache_dir     := directory of the cache
+    max_bytes     := maximum total size of the cache in bytes
+    '''
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:  # removed by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,77 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Plotting and debug visualization of the segmentation and loss steps. Kept apart from segmentation.py and loss.py so
+# that processes which only segment and score images never import matplotlib.
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+def plot_pixel_diff(uniq_vis_y, uniq_delta):
+    '''
+    Plots the segmentation figure of small elements from droplets, see "plot_pixel_diff" of watershed_segment.
+
+    Inputs:
+    uniq_vis_y    := pixel counts of the first-fold watershed elements, sorted from smallest to largest
+    uniq_delta    := difference between the pixel counts of elements n and n+Y
+    '''
+    uniq_vis_x = np.arange(0, len(uniq_vis_y), 1)
+    plt.figure(figsize=(4, 4))
+    plt.plot(uniq_vis_x, uniq_vis_y)
+    plt.axvline(np.argmax(uniq_delta), color='r', linestyle='--')
+    plt.title('First-fold watershed segmentation\nof small elements from droplets')
+    plt.xlabel('Element index')
+    plt.ylabel('# of pixels')
+    plt.show()
+
+def plot_droplet_fit(shape, window, drops, circ, n, lossl, mid_ax0, mid_ax1, radi, uniq_ax0, uniq_ax1):
+    '''
+    Plots a droplet next to the perfect circle it is compared to, see "iter_plot" of geometric_loss.
+
+    Inputs:
+    shape         := shape of the droplet count image
+    window        := (y0, y1, x0, x1) window of the droplet count image containing the droplet and the circle
+    drops         := droplet pixels within the window
+    circ          := circle pixels within the window
+    n             := droplet number
+    lossl         := loss of the droplet
+    mid_ax0       := centroid x position
+    mid_ax1       := centroid y position
+    radi          := circle radius
+    uniq_ax0      := droplet pixels summed over each column
+    uniq_ax1      := droplet pixels summed over each row
+    '''
+    y0, y1, x0, x1 = window
+    drops_full = np.zeros(shape)  # place the droplet window back into the full frame for plotting
+    drops_full[y0:y1, x0:x1] = drops
+    circ_full = np.zeros(shape)
+    circ_full[y0:y1, x0:x1] = circ
+    fig, (ax1, ax2) = plt.subplots(nrows=1, ncols=2)
+    x0 = int(mid_ax0 - np.max([radi, np.max(uniq_ax0)])) - 20
+    x1 = int(mid_ax0 + np.max([radi, np.max(uniq_ax0)])) + 20
+    y0 = int(mid_ax1 - np.max([radi, np.max(uniq_ax1)])) - 20
+    y1 = int(mid_ax1 + np.max([radi, np.max(uniq_ax1)])) + 20
+    ax1.imshow(drops_full)
+    ax1.scatter(mid_ax0, mid_ax1, c='r', s=1)
+    ax1.set_title('Imaged Droplet #' + str(n))
+    ax1.set_xlim([x0, x1])  # zoom into droplet
+    ax1.set_ylim([y0, y1])  # zoom into droplet
+    ax2.imshow(circ_full)  # zoom into droplet
+    ax2.scatter(mid_ax0, mid_ax1, c='r', s=1)
+    ax2.set_title('Estimated Droplet\nLoss Label = ' + str(round(lossl, 3)))
+    ax2.set_xlim([x0, x1])  # zoom into droplet
+    ax2.set_ylim([y0, y1])  # zoom into droplet
+    plt.show()
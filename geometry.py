@@ -0,0 +1,143 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import numpy as np
+import os
+import tempfile
+from functools import lru_cache
+
+# one record per droplet, see loss.geometric_loss; the image name is the partition key of the dataset, not a column
+GEOMETRY_DTYPE = np.dtype([('droplet', np.int32), ('centroid_x', np.float32), ('centroid_y', np.float32),
+                           ('chord_x', np.float32), ('chord_y', np.float32), ('pixels', np.float32)])
+
+def to_batch(droplet_geometry):
+    '''
+    Converts droplet geometry to a columnar record batch.
+
+    Inputs:
+    droplet_geometry  := list of lists returned by geometric_loss with "columnar" False, or a record batch
+
+    Outputs:
+    batch             := structured array of GEOMETRY_DTYPE with one record per droplet
+    '''
+    if isinstance(droplet_geometry, np.ndarray):
+        return droplet_geometry.astype(GEOMETRY_DTYPE, copy=False)
+    return np.array([tuple(geometry[1:]) for geometry in droplet_geometry], dtype=GEOMETRY_DTYPE)
+
+def partition_path(root, image, iteration=0):
+    '''
+    Returns the path of the partition of an image in the geometry dataset: root/iteration_<iteration>/<image>.npy.
+    '''
+    return os.path.join(root, f'iteration_{iteration}', image + '.npy')
+
+def append_geometry(root, batch, image, iteration=0):
+    '''
+    Appends the droplet geometry of an image to the on-disk geometry dataset, partitioned by Bayesian optimization
+    iteration and image. Appending an image again replaces its partition.
+
+    Inputs:
+    root              := directory of the dataset
+    batch             := record batch or droplet geometry list, see to_batch
+    image             := image name
+    iteration         := Bayesian optimization iteration the image belongs to
+    '''
+    path = partition_path(root, image, iteration)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, to_batch(batch))
+    os.replace(tmp, path)  # atomic, so concurrent readers never see partial partitions
+
+def _partitions(root, iterations=None, images=None):
+    '''
+    Lists the (iteration, image, path) of the partitions of the dataset, optionally only of the given iterations and images.
+    '''
+    partitions = []
+    if not os.path.isdir(root):
+        return partitions
+    for folder in sorted(os.listdir(root)):
+        if not folder.startswith('iteration_'):
+            continue
+        iteration = int(folder[len('iteration_'):])
+        if iterations is not None and iteration not in iterations:
+            continue
+        for name in sorted(os.listdir(os.path.join(root, folder))):
+            image = name[:-len('.npy')]
+            if name.endswith('.npy') and (images is None or image in images):
+                partitions.append((iteration, image, os.path.join(root, folder, name)))
+    return partitions
+
+def load_geometry(root, iterations=None, images=None):
+    '''
+    Loads droplet geometry from the dataset.
+
+    Inputs:
+    root              := directory of the dataset
+    iterations        := list of iterations to load. If None, loads all iterations.
+    images            := list of image names to load. If None, loads all images.
+
+    Outputs:
+    geometry          := dataframe of one row per droplet with its iteration, image, and GEOMETRY_DTYPE columns
+    '''
+    import pandas as pd
+    frames = []
+    for iteration, image, path in _partitions(root, iterations, images):
+        frame = pd.DataFrame(np.load(path))
+        frame.insert(0, 'Image', image)
+        frame.insert(0, 'Iteration', iteration)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame(columns=['Iteration', 'Image'] + list(GEOMETRY_DTYPE.names))
+    return pd.concat(frames, ignore_index=True)
+
+@lru_cache(maxsize=None)
+def _partition_moments(path, mtime):
+    '''
+    Computes the number of droplets and the sums of their diameters, squared diameters, and pixels in a partition.
+    Cached on the modification time, so repeated queries only read new or replaced partitions.
+    '''
+    batch = np.load(path)
+    diameter = (batch['chord_x'].astype(float) + batch['chord_y']) / 2
+    return len(batch), np.sum(diameter), np.sum(diameter ** 2), np.sum(batch['pixels'], dtype=float)
+
+def size_statistics(root, by='Image', iterations=None):
+    '''
+    Computes the droplet size distribution statistics of each condition from the dataset, where the diameter of a
+    droplet is the mean of its x- and y-axis chord lengths.
+
+    Inputs:
+    root              := directory of the dataset
+    by                := 'Image' for the statistics of each image, i.e., condition, or 'Iteration' for each iteration
+    iterations        := list of iterations to include. If None, includes all iterations.
+
+    Outputs:
+    stats             := dataframe indexed by "by" with the number of droplets, the mean and standard deviation of the
+                         droplet diameter in pixels, the polydispersity, i.e., the coefficient of variation of the
+                         diameter, and the mean number of pixels per droplet
+    '''
+    import pandas as pd
+    if by not in ('Image', 'Iteration'):
+        raise ValueError("Argument 'by' takes value either 'Image' or 'Iteration'.")
+    rows = []
+    for iteration, image, path in _partitions(root, iterations):
+        rows.append((iteration, image) + _partition_moments(path, os.path.getmtime(path)))
+    moments = pd.DataFrame(rows, columns=['Iteration', 'Image', 'Droplets', 'sum', 'sum_sq', 'pixels'])
+    moments = moments.groupby(by)[['Droplets', 'sum', 'sum_sq', 'pixels']].sum()
+    count = moments.Droplets.where(moments.Droplets > 0)  # conditions without droplets obtain missing statistics
+    mean = moments['sum'] / count
+    std = np.sqrt(np.maximum(moments.sum_sq / count - mean ** 2, 0))
+    return pd.DataFrame({'Droplets': moments.Droplets, 'MeanDiameter': mean, 'StdDiameter': std,
+                         'Polydispersity': std / mean, 'MeanPixels': moments.pixels / count})
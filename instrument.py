@@ -0,0 +1,203 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import functools
+import json
+import os
+import time
+import tracemalloc
+
+METRICS_ENV = 'DROPLET_METRICS' # environment variable holding the metrics path, so worker processes record to the same sink
+MEMORY_ENV = 'DROPLET_METRICS_MEMORY'
+
+_path = None # json lines file of stage records, None when instrumentation is disabled
+_memory = False
+_stack = [] # open stages of this process, innermost last
+
+def enable(path, memory=True):
+    '''
+    Enables recording of per-stage metrics to a json lines file, in this process and in worker processes started after.
+
+    Inputs:
+    path          := json lines file that stage records are appended to
+    memory        := True or False value. Records the peak allocated memory of each stage using tracemalloc, which
+                     slows down allocation heavy stages. If False, only wall and CPU time are recorded.
+    '''
+    global _path, _memory
+    _path, _memory = path, memory
+    os.environ[METRICS_ENV] = path
+    os.environ[MEMORY_ENV] = '1' if memory else '0'
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    '''
+    Disables recording of per-stage metrics. Stages open at the time are still recorded when they close.
+    '''
+    global _path, _memory
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _path, _memory = None, False
+    os.environ.pop(METRICS_ENV, None)
+    os.environ.pop(MEMORY_ENV, None)
+
+class _Stage:
+    '''
+    Context manager recording the wall time, CPU time, and peak allocated memory of one stage.
+    '''
+    def __init__(self, name, context):
+        self.name = name
+        self.context = context
+
+    def __enter__(self):
+        parent = _stack[-1].context if _stack else {}
+        self.context = dict(parent, **self.context)  # nested stages inherit the image or BO call they belong to
+        self.child_peak = 0
+        self.path, self.memory = _path, _memory  # kept, so that disabling instrumentation within the stage is safe
+        if self.memory:
+            self.start_memory, self.outer_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        _stack.append(self)
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        _stack.pop()
+        record = dict(self.context, stage=self.name, wall_s=wall, cpu_s=cpu, pid=os.getpid(), time=time.time())
+        if self.memory and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            record['peak_mb'] = (peak - self.start_memory) / 1e6
+            if _stack:  # the enclosing stage's peak was reset on entering this stage
+                _stack[-1].child_peak = max(_stack[-1].child_peak, self.outer_peak, peak)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+        return False
+
+class _NullStage:
+    '''
+    Context manager that does nothing, used while instrumentation is disabled.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+def stage(name, **context):
+    '''
+    Records the metrics of a stage of the crop -> segment -> loss -> BO chain, e.g., "with stage('imread'): ...".
+
+    Inputs:
+    name          := name of the stage
+    context       := values identifying the stage, e.g., image='im_1'; inherited by nested stages
+
+    Outputs:
+    A context manager; a shared no-op context manager if instrumentation is disabled.
+    '''
+    if _path is None:
+        return _NULL_STAGE
+    return _Stage(name, context)
+
+def annotate(**context):
+    '''
+    Adds values to the record of the innermost open stage, e.g., the outcome of a decision made within the stage.
+    Does nothing if instrumentation is disabled.
+    '''
+    if _path is not None and _stack:
+        _stack[-1].context.update(context)
+
+def timed(name):
+    '''
+    Decorator recording the metrics of every call of a function as a stage, see stage.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _path is None:
+                return function(*args, **kwargs)
+            with _Stage(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def summary(path, top=10):
+    '''
+    Summarizes recorded stage metrics.
+
+    Inputs:
+    path          := json lines file of stage records, see enable
+    top           := number of slowest images to report
+
+    Outputs:
+    stages        := dataframe of the count, total, mean, and max wall time, total CPU time, and max peak memory per stage,
+                     sorted from the largest total wall time
+    images        := dataframe of the "top" slowest images with their wall time per stage
+    '''
+    import pandas as pd
+    records = pd.read_json(path, lines=True)
+    if 'peak_mb' not in records:
+        records['peak_mb'] = float('nan')
+    stages = records.groupby('stage').agg(count=('wall_s', 'size'), total_wall_s=('wall_s', 'sum'),
+                                          mean_wall_s=('wall_s', 'mean'), max_wall_s=('wall_s', 'max'),
+                                          total_cpu_s=('cpu_s', 'sum'), max_peak_mb=('peak_mb', 'max'))
+    stages = stages.sort_values('total_wall_s', ascending=False)
+    if 'image' not in records:
+        return stages, pd.DataFrame()
+    per_image = records.dropna(subset=['image']).pivot_table(index='image', columns='stage', values='wall_s', aggfunc='sum')
+    slowest = records[records.stage == 'process_image'].groupby('image').wall_s.sum()
+    if slowest.empty:  # stages were not run through pipeline.process_image
+        slowest = per_image.max(axis=1)
+    images = per_image.loc[slowest.sort_values(ascending=False).index[:top]]
+    return stages, images
+
+def scoring_summary(path):
+    '''
+    Summarizes the scoring paths of coarse-to-fine scoring, see pipeline.score_image.
+
+    Inputs:
+    path          := json lines file of stage records, see enable
+
+    Outputs:
+    paths         := dataframe of the number of images and the mean and total wall time per scoring path, i.e., 'coarse'
+                     for images that exited after the coarse estimate and 'full' for images scored at full resolution
+    agreement     := dictionary of values: {time_saved_s, rank_correlation}, where time_saved_s estimates the time saved
+                     as the number of coarse exits times the difference of the mean wall time of both paths, and
+                     rank_correlation is the Spearman correlation of the coarse and full resolution total losses of the
+                     images scored at full resolution whose coarse estimate did not fail
+    '''
+    import pandas as pd
+    records = pd.read_json(path, lines=True)
+    if 'scoring' not in records:
+        return pd.DataFrame(), {'time_saved_s': 0., 'rank_correlation': float('nan')}
+    records = records[(records.stage == 'process_image') & records.scoring.notna()]
+    paths = records.groupby('scoring').agg(images=('wall_s', 'size'), mean_wall_s=('wall_s', 'mean'),
+                                           total_wall_s=('wall_s', 'sum'))
+    time_saved = 0.
+    if {'coarse', 'full'} <= set(paths.index):
+        time_saved = paths.images['coarse'] * (paths.mean_wall_s['full'] - paths.mean_wall_s['coarse'])
+    full = records[records.scoring == 'full']
+    if 'coarse_failed' in full:  # failed coarse estimates take the maximum loss rather than an estimate
+        full = full[full.coarse_failed.ne(True)]
+    rank_correlation = full.coarse_loss.corr(full.total_loss, method='spearman') if len(full) > 1 else float('nan')
+    return paths, {'time_saved_s': time_saved, 'rank_correlation': rank_correlation}
+
+if os.environ.get(METRICS_ENV):  # worker processes inherit the sink of the process that enabled instrumentation
+    enable(os.environ[METRICS_ENV], memory=os.environ.get(MEMORY_ENV, '1') == '1')
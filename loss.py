@@ -16,8 +16,11 @@
 
 import cv2 # pip install opencv-python          # https://pypi.org/project/opencv-python/
 import numpy as np
-import matplotlib.pyplot as plt
+from scipy import ndimage
+from instrument import timed
+from geometry import GEOMETRY_DTYPE
 
+@timed('yield_loss')
 def yield_loss(droplet_count, max_droplets):
     ''''
     Calculates yield loss => the balanced optimization of having many droplets with large area footprint.
@@ -40,7 +43,8 @@ def yield_loss(droplet_count, max_droplets):
     yld_loss = (count_loss + area_loss) / 2 # minimize this yield loss. We want to maximize number of droplets but also maximize the area of each droplet.
     return yld_loss
 
-def geometric_loss(droplet_count, image_name, iter_plot):
+@timed('geometric_loss')
+def geometric_loss(droplet_count, image_name, iter_plot, columnar=False):
     '''
      Calculates geometric loss => how closely each droplet maps to a perfect circle using computer vision.
      If droplets are close to the circle, they obtain a low loss score.
@@ -49,40 +53,50 @@ def geometric_loss(droplet_count, image_name, iter_plot):
      droplet_count              := watershed segmented droplet count image, each individual droplet should have uniquely indexed pixels
      image_name                 := Name of droplet image used to organize to the droplet geometric data list.
      iter_plot                  := True or False value determines whether or not to iteratively plot each droplet mapping to a perfect circle
+     columnar                   := True or False value. If True, returns the droplet geometry as a record batch, see geometry.py
 
      Outputs:
      geometric_loss             := value in range[0,1] that represents how closely ALL droplets map to a perfect circle
      droplet_geometry           := list of lists, where each sublist corresponds to the geometric properties of a single droplet.
                                    This variable has the format: ['image name','droplet number', 'centroid_x position','centroid_y position','chord_x length','chord_y length','number of pixels']
+                                   If "columnar" is True, a structured array of geometry.GEOMETRY_DTYPE with one record per droplet and without the image name.
      '''
     loss_list = []
-    uniq_select = np.unique(droplet_count)
     droplet_geometry = []
+    uniq_select, inverse = np.unique(droplet_count, return_inverse=True)  # index every pixel by its position in the sorted unique labels
+    inverse = inverse.reshape(droplet_count.shape)
+    objects = ndimage.find_objects(inverse + 1)  # bounding box of each unique label, found in a single pass over the image
+    height, width = droplet_count.shape[:2]
     for n in range(len(uniq_select)):
         if n == 0: # pass on background
             pass
         else:
-            uniq = uniq_select[n]
-            drops = droplet_count.copy()
-            drops[drops != uniq] = 0
-            drops[drops == uniq] = 1
-            circle_init = np.zeros(np.shape(drops))
+            box_y, box_x = objects[n]
+            whole_frame = uniq_select[n] == 0  # a zero label following negative labels binarizes to the whole frame
+            if whole_frame:
+                box_y, box_x = slice(0, height), slice(0, width)
+            drops = ((inverse[box_y, box_x] == n) | whole_frame).astype(droplet_count.dtype)  # droplet pixels within its bounding box only
 
             # axis 1, summing each row
             uniq_ax1 = np.sum(drops, axis=1)
-            start_ax1 = np.where(uniq_ax1 == uniq_ax1[uniq_ax1 > 0][0])[0][0]  # get the index of the first non-zero row value
-            mid_ax1 = start_ax1 + sum(np.sum(drops, axis=1) > 0) // 2  # sum only true values to find the length
-            diam_ax1 = (np.sum(drops, axis=1)[mid_ax1] + np.max(uniq_ax1)) / 2
+            mid_ax1 = box_y.start + np.count_nonzero(uniq_ax1) // 2  # first non-zero row plus half of the number of non-zero rows
+            diam_ax1 = (uniq_ax1[mid_ax1 - box_y.start] + np.max(uniq_ax1)) / 2
 
             # axis 0, summing each column
             uniq_ax0 = np.sum(drops, axis=0)
-            start_ax0 = np.where(uniq_ax0 == uniq_ax0[uniq_ax0 > 0][0])[0][0]  # get the index of the first non-zero row value
-            mid_ax0 = start_ax0 + sum(np.sum(drops, axis=0) > 0) // 2  # sum only true values to find the length
-            diam_ax0 = (np.sum(drops, axis=0)[mid_ax0] + np.max(uniq_ax0)) / 2
+            mid_ax0 = box_x.start + np.count_nonzero(uniq_ax0) // 2  # first non-zero column plus half of the number of non-zero columns
+            diam_ax0 = (uniq_ax0[mid_ax0 - box_x.start] + np.max(uniq_ax0)) / 2
 
             radi = int((diam_ax0 / 2 + diam_ax1 / 2) / 2)
 
-            circ = cv2.circle(circle_init, (mid_ax0, mid_ax1), radi, (1, 1, 1), -1)
+            # the estimated circle may extend past the bounding box, so compare both within the window containing them
+            y0 = max(min(box_y.start, mid_ax1 - radi), 0)
+            y1 = min(max(box_y.stop, mid_ax1 + radi + 1), height)
+            x0 = max(min(box_x.start, mid_ax0 - radi), 0)
+            x1 = min(max(box_x.stop, mid_ax0 + radi + 1), width)
+            drops = ((inverse[y0:y1, x0:x1] == n) | whole_frame).astype(droplet_count.dtype)
+            circle_init = np.zeros(np.shape(drops))
+            circ = cv2.circle(circle_init, (int(mid_ax0 - x0), int(mid_ax1 - y0)), radi, (1, 1, 1), -1)
             inside = drops + circ - 1
             inside[inside < 0] = 0
             total = np.abs(circ - drops) + inside
@@ -91,25 +105,17 @@ def geometric_loss(droplet_count, image_name, iter_plot):
             loss_list.append(lossl)
 
             # append geoemtry data to dataframe for every droplet in every sample
-            droplet_geometry.append([image_name, n, mid_ax0, mid_ax1, diam_ax0, diam_ax1, np.sum(drops)])  # ['image name','droplet number', 'centroid_x position','centroid_y position','chord_x length','chord_y length','number of pixels']
+            droplet_geometry.append((n, mid_ax0, mid_ax1, diam_ax0, diam_ax1, np.sum(drops)))  # ['droplet number', 'centroid_x position','centroid_y position','chord_x length','chord_y length','number of pixels']
 
             if iter_plot:
-                fig, (ax1, ax2) = plt.subplots(nrows=1, ncols=2)
-                x0 = int(mid_ax0 - np.max([radi, np.max(uniq_ax0)])) - 20
-                x1 = int(mid_ax0 + np.max([radi, np.max(uniq_ax0)])) + 20
-                y0 = int(mid_ax1 - np.max([radi, np.max(uniq_ax1)])) - 20
-                y1 = int(mid_ax1 + np.max([radi, np.max(uniq_ax1)])) + 20
-                ax1.imshow(drops)
-                ax1.scatter(mid_ax0, mid_ax1, c='r', s=1)
-                ax1.set_title('Imaged Droplet #' + str(n))
-                ax1.set_xlim([x0, x1])  # zoom into droplet
-                ax1.set_ylim([y0, y1])  # zoom into droplet
-                ax2.imshow(circ)  # zoom into droplet
-                ax2.scatter(mid_ax0, mid_ax1, c='r', s=1)
-                ax2.set_title('Estimated Droplet\nLoss Label = ' + str(round(lossl, 3)))
-                ax2.set_xlim([x0, x1])  # zoom into droplet
-                ax2.set_ylim([y0, y1])  # zoom into droplet
-                plt.show()
+                from diagnostics import plot_droplet_fit
+                plot_droplet_fit(droplet_count.shape, (y0, y1, x0, x1), drops, circ, n, lossl, mid_ax0, mid_ax1, radi,
+                                 uniq_ax0, uniq_ax1)
+
+    if columnar:
+        droplet_geometry = np.array(droplet_geometry, dtype=GEOMETRY_DTYPE).reshape(-1)
+    else:
+        droplet_geometry = [[image_name, *geometry] for geometry in droplet_geometry]  # prepend the image name
 
     total_pixels = np.sum(droplet_count != 0)  # total number of droplet pixels
     geom_loss = np.sum(loss_list) / total_pixels  # sum the individual losses (each weighted by # of pixels in each droplet) and divide by total number of droplet pixels
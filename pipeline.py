@@ -0,0 +1,249 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Entry point of the crop -> segment -> loss chain for worker processes. It only imports cv2, numpy, and scipy, never
+# matplotlib (see diagnostics.py), pandas, or GPy, so that short-lived workers start quickly. Modules imported by
+# workers therefore import matplotlib, pandas, GPy, and the slow scipy.signal and scipy.sparse inside the functions
+# that need them, e.g., plotting, csv and dataframe output, or the main process of a command line script.
+
+import cv2 # pip install opencv-python          # https://pypi.org/project/opencv-python/
+import numpy as np
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from crop import read_rotate_crop
+from segmentation import watershed_segment, watershed_segment_tiled, SegmentationError
+from loss import yield_loss, geometric_loss
+from cache import cache_key, load_result, save_result
+from instrument import stage, annotate
+from geometry import to_batch
+
+logger = logging.getLogger(__name__)
+
+def image_name(path):
+    '''
+    Returns the image name used in the "Image" column of the parameter csv file, i.e., the file name without extension.
+    '''
+    return os.path.basename(path).split('.')[0]
+
+def failed_record(image):
+    '''
+    Returns the record of a failed image, see process_image: no yield or geometric loss, the maximum total loss of 1,
+    and no droplets.
+    '''
+    return image, np.nan, np.nan, 1., to_batch([])
+
+def collect_record(future, path):
+    '''
+    Returns the record of a finished process_image call. If the image could not be segmented, e.g., a blank or jetting
+    image, see segmentation.SegmentationError, logs the error and returns the image as failed, see failed_record, so
+    that one image does not stop a batch. Other errors, e.g., a missing image or parameter, are raised.
+
+    Inputs:
+    future                  := finished future of process_image
+    path                    := image path passed to process_image
+
+    Outputs:
+    record                  := tuple of (image name, yield loss, geometric loss, total loss, droplet geometry)
+    '''
+    try:
+        return future.result()
+    except SegmentationError:
+        logger.exception("Scoring image '%s' failed, so it is recorded as failed.", path)
+        return failed_record(image_name(path))
+
+def process_image(path, params, failed=False, cache_dir=None, cache_bytes=None, best_loss=None):
+    '''
+    Runs the crop -> segment -> loss chain on a single droplet image.
+
+    Inputs:
+    path                    := image path
+    params                  := dictionary of values: {rotate_crop_params, double_watershed, large_elements_pixels,
+                               pixel_diff, drop_dilate, remove_artefacting, max_droplets} passed to read_rotate_crop,
+                               watershed_segment, and yield_loss. Optionally {roi_only}, see read_rotate_crop, and
+                               {tile_size, halo} to segment high-resolution images with watershed_segment_tiled,
+                               and {coarse} for coarse-to-fine scoring, see score_image.
+    failed                  := True or False value from the "Failed" column of the parameter csv file. Failed images
+                               are not segmented and obtain the maximum total loss of 1.
+    cache_dir               := directory of the on-disk result cache, see cache.py. If None, results are not cached.
+                               Results are keyed on the image contents and "params", so only new or changed images,
+                               or images processed with different parameters, are recomputed.
+    cache_bytes             := maximum size of the result cache in bytes, evicting the least recently used entries.
+                               If None, the cache grows without bound.
+    best_loss               := lowest total loss seen so far, see score_image
+
+    Outputs:
+    record                  := tuple of (image name, yield loss, geometric loss, total loss, droplet geometry), where the
+                               droplet geometry is a record batch, see geometry.py
+    '''
+    image = image_name(path)
+    with stage('process_image', image=image):
+        return _process_image(path, image, params, failed, cache_dir, cache_bytes, best_loss)
+
+def _process_image(path, image, params, failed, cache_dir, cache_bytes, best_loss):
+    '''
+    Runs the crop -> segment -> loss chain on a single droplet image, see process_image.
+    '''
+    if failed:
+        return failed_record(image)
+    if cache_dir is not None:
+        key = cache_key(path, params)
+        entry = load_result(cache_dir, key)
+        if entry is not None:
+            return (image, entry['yield_loss'], entry['geom_loss'], entry['total_loss'],
+                    to_batch(entry['droplet_geometry']))  # entries cached before the columnar batches hold lists
+    img = read_rotate_crop(img_path=path, rotate_crop_params=params['rotate_crop_params'],
+                           roi_only=params.get('roi_only', False))
+    droplet_count, yld_loss, geom_loss, total_loss, droplet_geometry, scoring = score_image(img, image, params,
+                                                                                          best_loss)
+    if cache_dir is not None and scoring == 'full':  # coarse estimates depend on the best loss so far, so are not cached
+        save_result(cache_dir, key, {'droplet_count': droplet_count, 'yield_loss': yld_loss, 'geom_loss': geom_loss,
+                                     'total_loss': total_loss, 'droplet_geometry': droplet_geometry}, cache_bytes)
+    return image, yld_loss, geom_loss, total_loss, droplet_geometry
+
+def score_image(img, image, params, best_loss=None):
+    '''
+    Runs the segment -> loss chain on a rotated and cropped droplet image. If params contains {coarse}, the losses are
+    first estimated on a downsampled copy of the image, and the image is only scored at full resolution if the
+    estimate is promising, so that clearly failed conditions, e.g., jetting or no droplets, exit early.
+
+    Inputs:
+    img                     := rotated and cropped droplet image
+    image                   := image name used in the droplet geometry
+    params                  := dictionary of segmentation and loss parameters, see process_image. Optionally
+                               {coarse}, a dictionary of values: {scale, threshold, margin}, and optionally
+                               {rescore_failed}, where
+        scale               := downsampling factor of the coarse estimate, e.g., 0.25
+        threshold           := images with a coarse total loss below the threshold are scored at full resolution.
+                               A threshold of 1 scores every image at both resolutions, e.g., to calibrate the threshold,
+                               except failed coarse estimates.
+        margin              := images with a coarse total loss within "margin" of "best_loss" are scored at full resolution
+        rescore_failed      := True or False value. Coarse estimates that fail, i.e., segmentation raises or finds no
+                               droplets, obtain the maximum total loss of 1 and exit early, unless True, in which case
+                               they are scored at full resolution. Defaults to False.
+    best_loss               := lowest total loss seen so far. If None, only "threshold" selects images for full resolution.
+
+    Outputs:
+    droplet_count           := image of droplet interiors indexed by droplet number, downsampled for coarse exits
+    yld_loss                := yield loss
+    geom_loss               := geometric loss
+    total_loss              := average of the yield and geometric losses
+    droplet_geometry        := droplet geometry record batch, see geometry.py, in full resolution pixels
+    scoring                 := 'coarse' if the image exited after the coarse estimate, otherwise 'full'.
+                               Also recorded with the coarse and total losses and whether the coarse estimate failed
+                               in the "process_image" stage records
+                               when instrumentation is enabled, see instrument.scoring_summary.
+    '''
+    coarse = params.get('coarse')
+    if coarse is None:
+        return _score_image(img, image, params) + ('full',)
+    scale = coarse['scale']
+    small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    area = scale ** 2  # pixel counts shrink with the square of the scale
+    coarse_params = dict(params, large_elements_pixels=params['large_elements_pixels'] * area,
+                         pixel_diff=params['pixel_diff'] * area,
+                         drop_dilate=max(int(round(params['drop_dilate'] * scale)), 1), tile_size=None)
+    with stage('coarse_score'):
+        try:
+            droplet_count, yld_loss, geom_loss, coarse_loss, droplet_geometry = _score_image(small, image, coarse_params)
+        except SegmentationError:  # e.g., a blank or jetting image leaves too few elements to clean at the coarse scale
+            droplet_count, yld_loss, geom_loss, coarse_loss, droplet_geometry = (np.zeros(small.shape[:2], np.int32),
+                                                                                 np.nan, np.nan, np.nan, to_batch([]))
+    failed = len(droplet_geometry) == 0 or coarse_loss != coarse_loss  # no droplets or no loss, i.e., nan
+    if failed:
+        coarse_loss = 1.  # the maximum loss, like failed images
+    if (failed and coarse.get('rescore_failed', False)) or (not failed and (coarse_loss < coarse['threshold'] or (
+            best_loss is not None and coarse_loss <= best_loss + coarse['margin']))):
+        droplet_count, yld_loss, geom_loss, total_loss, droplet_geometry = _score_image(img, image, params)
+        annotate(scoring='full', coarse_loss=coarse_loss, total_loss=total_loss, coarse_failed=failed)
+        return droplet_count, yld_loss, geom_loss, total_loss, droplet_geometry, 'full'
+    for field in ['centroid_x', 'centroid_y', 'chord_x', 'chord_y']:  # back to full resolution pixels
+        droplet_geometry[field] /= scale
+    droplet_geometry['pixels'] /= area
+    annotate(scoring='coarse', coarse_loss=coarse_loss, total_loss=coarse_loss, coarse_failed=failed)
+    return droplet_count, yld_loss, geom_loss, coarse_loss, droplet_geometry, 'coarse'
+
+def _score_image(img, image, params):
+    '''
+    Runs the segment -> loss chain on a rotated and cropped droplet image at its resolution, see score_image.
+    '''
+    segment_params = dict(image=img, double_watershed=params['double_watershed'],
+                          large_elements_pixels=params['large_elements_pixels'], pixel_diff=params['pixel_diff'],
+                          drop_dilate=params['drop_dilate'], plot_pixel_diff=False,
+                          remove_artefacting=params['remove_artefacting'])
+    if params.get('tile_size') is None:
+        droplet_count = watershed_segment(**segment_params)
+    else:
+        droplet_count = watershed_segment_tiled(**segment_params, tile_size=params['tile_size'],
+                                                halo=params.get('halo', 128))
+    yld_loss = yield_loss(droplet_count=droplet_count, max_droplets=params['max_droplets'])
+    geom_loss, droplet_geometry = geometric_loss(droplet_count=droplet_count, image_name=image, iter_plot=False,
+                                                 columnar=True)
+    total_loss = (yld_loss + geom_loss) / 2
+    return droplet_count, yld_loss, geom_loss, total_loss, droplet_geometry
+
+def process_images(paths, params, workers=1, failed=None, chunk_size=None, cache_dir=None, cache_bytes=None):
+    '''
+    Runs the crop -> segment -> loss chain over many droplet images in parallel, streaming the results back as they finish.
+
+    Inputs:
+    paths                   := list of image paths
+    params                  := dictionary of crop, segmentation, and loss parameters, see process_image
+    workers                 := number of worker processes. If 1, images are processed one at a time in this process.
+    failed                  := list of True or False values from the "Failed" column of the parameter csv file, in the
+                               order of "paths". If None, no images are failed.
+    chunk_size              := maximum number of images in flight at a time, bounding memory use regardless of the
+                               number of images. Defaults to 4 images per worker.
+    cache_dir               := directory of the on-disk result cache shared by all workers, see process_image
+    cache_bytes             := maximum size of the result cache in bytes, see process_image
+
+    Outputs:
+    records                 := generator of (image name, yield loss, geometric loss, total loss, droplet geometry)
+                               tuples in order of completion. Images that cannot be segmented are logged and recorded
+                               as failed, see collect_record.
+    '''
+    paths = list(paths)
+    failed = [False] * len(paths) if failed is None else [bool(f) for f in failed]
+    if len(failed) != len(paths):
+        raise ValueError("Argument 'failed' must have one value per image path.")
+    best_loss = None  # lowest total loss so far, for coarse-to-fine scoring
+    if workers == 1:
+        for path, fail in zip(paths, failed):
+            try:
+                record = process_image(path, params, fail, cache_dir, cache_bytes, best_loss)
+            except SegmentationError:
+                logger.exception("Scoring image '%s' failed, so it is recorded as failed.", path)
+                record = failed_record(image_name(path))
+            best_loss = record[3] if best_loss is None else np.fmin(best_loss, record[3])
+            yield record
+        return
+    chunk_size = 4 * workers if chunk_size is None else chunk_size
+    queue = iter(zip(paths, failed))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}  # image path of each future in flight
+        for path, fail in queue:
+            pending[executor.submit(process_image, path, params, fail, cache_dir, cache_bytes, best_loss)] = path
+            if len(pending) >= chunk_size:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = collect_record(future, pending.pop(future))
+                best_loss = record[3] if best_loss is None else np.fmin(best_loss, record[3])
+                yield record
+                for path, fail in queue:  # top up with the next image for each one finished
+                    pending[executor.submit(process_image, path, params, fail, cache_dir, cache_bytes, best_loss)] = path
+                    break
@@ -16,8 +16,15 @@
 
 import cv2 # pip install opencv-python          # https://pypi.org/project/opencv-python/
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import signal, ndimage # requires scipy version 1.4.1 to operate GPyOpt version 1.2.6
+from scipy import ndimage # requires scipy version 1.4.1 to operate GPyOpt version 1.2.6
+from instrument import stage, timed
+
+
+class SegmentationError(ValueError):
+    '''
+    Raised when an image cannot be segmented, e.g., a blank or jetting image that leaves too few elements after the
+    large elements are removed to find the small elements threshold.
+    '''
 
 
 def segment_on_dt(a, img, threshold):
@@ -56,6 +63,138 @@ def segment_on_dt(a, img, threshold):
     return 255 - lbl, wat, lab  # return lab, the segmented and indexed droplets
 
 
+def _pad_chord(chord, span, length):
+    '''
+    Pads a chord profile taken over a bounding box with the zero background on each side that lies inside the image,
+    so that signal.find_peaks finds the same peaks as on the full-image profile.
+
+    Inputs:
+    chord     := sum of object pixels along one axis of its bounding box
+    span      := slice of the bounding box along that axis
+    length    := image size along that axis
+
+    Outputs:
+    chord     := padded chord profile
+    '''
+    return np.pad(chord, (int(span.start > 0), int(span.stop < length)))
+
+
+def _clean_elements(uniq_full, uniq_counts, large_elements_pixels, pixel_diff, plot_pixel_diff):
+    '''
+    Removes the large and small elements of the first fold of watershed by their pixel counts.
+
+    Inputs:
+    uniq_full               := sorted unique watershed indices
+    uniq_counts             := number of pixels of each index
+    large_elements_pixels   := see watershed_segment
+    pixel_diff              := see watershed_segment
+    plot_pixel_diff         := see watershed_segment
+
+    Outputs:
+    relabel                 := lookup table from the position of each index in uniq_full to its cleaned index,
+                               where removed elements are 0
+    '''
+    # remove large elements
+    large_elements_thresh = large_elements_pixels
+    relabel = uniq_full.copy()  # lookup table from the original indices to the cleaned indices, applied once at the end
+    relabel[uniq_counts > large_elements_thresh] = 0  # remove all large elements
+    uniq_kept, uniq_kept_index = np.unique(relabel,
+                                           return_inverse=True)  # update list of unique watershed indices and pixel counts
+    uniq_kept_counts = np.bincount(uniq_kept_index, weights=uniq_counts).astype(uniq_counts.dtype)
+    uniq_vis_y = np.sort(uniq_kept_counts[1:])  # sort the remaining counts from smallest to largest
+    Y = 5  # number of elements to take the difference between: n and n+Y elements
+    # remove small elements
+    uniq_delta = uniq_vis_y[Y:] - uniq_vis_y[:-Y]  # take the difference between n and n+Y elements
+    if len(uniq_delta) == 0:
+        raise SegmentationError(f"At least {Y + 1} elements must remain after removing the large elements, "
+                                f"not {len(uniq_vis_y)}.")
+    small_elements_thresh = uniq_vis_y[np.argmax(uniq_delta)]  # find index where n and n+Y difference is largest
+
+    if plot_pixel_diff == True:
+        from diagnostics import plot_pixel_diff as plot
+        plot(uniq_vis_y, uniq_delta)
+    else:
+        pass
+    if small_elements_thresh >= pixel_diff:  # only if calculated threshold is larger than the user defined small elements do we remove small elements
+        small_elements = uniq_kept_counts[uniq_kept_index] <= small_elements_thresh  # mask small elements
+        relabel[small_elements] = 0  # remove all small elements
+    else:
+        pass
+    return relabel
+
+
+def _polymodal(chord_v, chord_h):
+    '''
+    Tests whether the chord profiles of an object along the x- and y-axis have more than one peak, i.e., whether the
+    object is an artefacting space between droplets rather than a droplet.
+    '''
+    from scipy import signal
+    diff_v = signal.find_peaks(chord_v)  # find the peaks of data
+    diff_h = signal.find_peaks(chord_h)  # find the peaks of data
+    return len(diff_v[0]) > 1 or len(diff_h[0]) > 1
+
+
+def _first_fold(image, double_watershed):
+    '''
+    Runs the steps of watershed_segment that do not depend on its cleaning parameters: grayscale conversion, median
+    blur, Otsu's binarization, morphological opening, and the first fold of watershed.
+
+    Inputs:
+    image                   := input droplet image to segment
+    double_watershed        := True or False value, see watershed_segment
+
+    Outputs:
+    result                  := Borders of segmented droplets, see segment_on_dt
+    water                   := Segmented droplets via watershed, see segment_on_dt
+    '''
+    RGB_threshold = 0
+    img = image.copy()
+
+    if double_watershed == False:
+        img = 255 - img
+    img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    img = cv2.medianBlur(img, 5)
+    _, img_bin = cv2.threshold(img, 0, 255,
+                               # threshold image using Otsu's binarization # https://docs.opencv.org/4.x/d7/d4d/tutorial_py_thresholding.html
+                               cv2.THRESH_OTSU)
+    img_bin = cv2.morphologyEx(img_bin, cv2.MORPH_OPEN,
+                               np.ones((4, 4), dtype=int))
+    # first fold of watershed to remove white centers
+    with stage('segment_on_dt', fold=1):
+        result, water, labs = segment_on_dt(a=img, img=img_bin,
+                                            threshold=RGB_threshold)  # segment droplets from background and return indexed droplets
+    return result, water
+
+
+def _artefacts(uniq_full, uniq_index, candidates):
+    '''
+    Tests which watershed elements are artefacting spaces between droplets, see "remove_artefacting" of watershed_segment.
+
+    Inputs:
+    uniq_full               := sorted unique watershed indices
+    uniq_index              := position of every pixel's index in uniq_full
+    candidates              := positions in uniq_full of the elements to test
+
+    Outputs:
+    artefacts               := positions in uniq_full of the candidates whose chord profiles are polymodal
+    '''
+    objects = ndimage.find_objects(uniq_index + 1)  # bounding box of every original index
+    artefacts = []
+    for n in candidates:
+        rows, cols = objects[n]
+        shapetest = (uniq_index[rows, cols] == n).astype(float)  # object pixels within its bounding box only
+        if uniq_full[n] < 0:
+            shapetest = shapetest * uniq_full[n]  # watershed borders keep their negative index
+        else:
+            pass
+        chord_v = _pad_chord(np.sum(shapetest, axis=0), cols, uniq_index.shape[1])  # find the sum of object pixels along x-axis
+        chord_h = _pad_chord(np.sum(shapetest, axis=1), rows, uniq_index.shape[0])  # find the sum of object pizels along the y-axis
+        if _polymodal(chord_v, chord_h):  # if the data is polymodal, remove the objects
+            artefacts.append(n)
+    return np.array(artefacts, dtype=int)
+
+
+@timed('watershed_segment')
 def watershed_segment(image, double_watershed, large_elements_pixels, pixel_diff, drop_dilate, plot_pixel_diff,
                       remove_artefacting):
     '''
@@ -81,78 +220,19 @@ def watershed_segment(image, double_watershed, large_elements_pixels, pixel_diff
     binarized               := Binary image indicating total droplet area vs. empty tube space
     '''
     RGB_threshold = 0
-    pixel_threshold = 0
-    img = image.copy()
-
-    if double_watershed == False:
-        img = 255 - img
-    img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    img = cv2.medianBlur(img, 5)
-    _, img_bin = cv2.threshold(img, 0, 255,
-                               # threshold image using Otsu's binarization # https://docs.opencv.org/4.x/d7/d4d/tutorial_py_thresholding.html
-                               cv2.THRESH_OTSU)
-    img_bin = cv2.morphologyEx(img_bin, cv2.MORPH_OPEN,
-                               np.ones((4, 4), dtype=int))
-    # first fold of watershed to remove white centers
-    result, water, labs = segment_on_dt(a=img, img=img_bin,
-                                        threshold=RGB_threshold)  # segment droplets from background and return indexed droplets
+    result, water = _first_fold(image, double_watershed)
 
     if double_watershed == True:
-        # remove large elements
-        large_elements_thresh = large_elements_pixels
-        uniq_full, uniq_counts = np.unique(water,
-                                           return_counts=True)  # get all unique watershed indices with pixel counts
-        large_elements = uniq_full[uniq_counts > large_elements_thresh]  # mask large elements
-        for n in range(len(large_elements)):
-            water[water == large_elements[n]] = 0  # remove all large elements
-        uniq_full, uniq_counts = np.unique(water,
-                                           return_counts=True)  # update list of unique watershed indixes and pixel counts
-        uniq_vis_y = np.sort(uniq_counts[1:])  # sort the remaining counts from smallest to largest
-        uniq_delta = []  # initialize list to populate
-        Y = 5  # number of elements to take the difference between: n and n+Y elements
-        # remove small elements
-        for n in range(len(uniq_vis_y) - Y):
-            uniq_delta.append(uniq_vis_y[n + Y] - uniq_vis_y[n])  # take the difference between n and n+Y elements
-        uniq_delta = np.array(uniq_delta)  # convert to np array
-        small_elements_thresh = uniq_vis_y[np.argmax(uniq_delta)]  # find index where n and n+Y difference is largest
-
-        if plot_pixel_diff == True:
-            uniq_vis_x = np.arange(0, len(uniq_vis_y), 1)
-            plt.figure(figsize=(4, 4))
-            plt.plot(uniq_vis_x, uniq_vis_y)
-            plt.axvline(np.argmax(uniq_delta), color='r', linestyle='--')
-            plt.title('First-fold watershed segmentation\nof small elements from droplets')
-            plt.xlabel('Element index')
-            plt.ylabel('# of pixels')
-            plt.show()
-        else:
-            pass
-        if small_elements_thresh >= pixel_diff:  # only if calculated threshold is larger than the user defined small elements do we remove small elements
-            small_elements = uniq_full[uniq_counts <= small_elements_thresh]  # mask small elements
-            for n in range(len(small_elements)):
-                water[water == small_elements[n]] = 0  # remove all small elements
-        else:
-            pass
+        uniq_full, uniq_index, uniq_counts = np.unique(water, return_inverse=True,
+                                                       return_counts=True)  # get all unique watershed indices with pixel counts
+        uniq_index = uniq_index.reshape(water.shape)  # position of every pixel's index in uniq_full
+        relabel = _clean_elements(uniq_full, uniq_counts, large_elements_pixels, pixel_diff, plot_pixel_diff)
 
         #        Remove artefacting spaces between droplets, only necessary for double watershed
         #        Remove artefacting removes the erroneously segmented spaces between droplets as actual droplets. Enabling this may remove actual droplets by accident.
         if remove_artefacting:
-            uniq_cleaned = np.unique(water)  # update list of unique indices after cleaning
-            for n in range(len(uniq_cleaned)):
-                shapetest = water.copy()  # reset each iteration
-                shapetest[shapetest != uniq_cleaned[n]] = 0
-                if uniq_cleaned[n] > 0:
-                    shapetest = shapetest / uniq_cleaned[n]
-                else:
-                    pass
-                chord_v = np.sum(shapetest, axis=0)  # find the sum of object pixels along x-axis
-                chord_h = np.sum(shapetest, axis=1)  # find the sum of object pizels along the y-axis
-                diff_v = signal.find_peaks(chord_v)  # find the peaks of data
-                diff_h = signal.find_peaks(chord_h)  # find the peaks of data
-                if (len(diff_v[0]) > 1 or len(diff_h[0]) > 1):  # if the data is polymodal, remove the objects
-                    water[water == uniq_cleaned[n]] = 0
-                else:
-                    pass
+            relabel[_artefacts(uniq_full, uniq_index, np.flatnonzero(relabel))] = 0  # background is never polymodal
+        water = relabel[uniq_index]  # apply the cleaned indices in a single pass
         # second fold of watershed using cleaned image as a base
         water = water / 1.
         kernel = np.ones((drop_dilate, drop_dilate), np.uint8)
@@ -168,8 +248,9 @@ def watershed_segment(image, double_watershed, large_elements_pixels, pixel_diff
                                    cv2.THRESH_OTSU)
         img_bin = cv2.morphologyEx(img_bin, cv2.MORPH_OPEN,
                                    np.ones((5, 5), dtype=int))
-        result_double, water_double, labs_double = segment_on_dt(a=base, img=img_bin,
-                                                                 threshold=RGB_threshold)  # segment droplets from background and return indexed droplets
+        with stage('segment_on_dt', fold=2):
+            result_double, water_double, labs_double = segment_on_dt(a=base, img=img_bin,
+                                                                     threshold=RGB_threshold)  # segment droplets from background and return indexed droplets
         result_double[result_double == 255] = 0
         droplet_count = water1.copy()
         return droplet_count
@@ -179,4 +260,281 @@ def watershed_segment(image, double_watershed, large_elements_pixels, pixel_diff
         droplet_count = result.copy()
         return droplet_count
     else:
-        raise ValueError("Argument 'double_watershed' takes value either True or False.")
\ No newline at end of file
+        raise ValueError("Argument 'double_watershed' takes value either True or False.")
+
+
+def segment_prefix(image, double_watershed, remove_artefacting=True):
+    '''
+    Computes the intermediates of watershed_segment that do not depend on "large_elements_pixels", "pixel_diff",
+    "drop_dilate", and "remove_artefacting", so that many combinations of them can be segmented from one image with
+    prefix_relabel and prefix_droplet_count, e.g., for a parameter sweep.
+
+    Inputs:
+    image                   := input droplet image to segment
+    double_watershed        := True or False value, see watershed_segment
+    remove_artefacting      := True or False value. If True, tests every element for artefacting once, so that
+                               prefix_relabel can remove artefacting elements.
+
+    Outputs:
+    prefix                  := dictionary of values: {double_watershed, droplet_count} for single watershed, whose result
+                               does not depend on the other parameters, or {double_watershed, uniq_full, uniq_index,
+                               uniq_counts, artefacts} for double watershed, see watershed_segment
+    '''
+    if double_watershed not in (True, False):
+        raise ValueError("Argument 'double_watershed' takes value either True or False.")
+    result, water = _first_fold(image, double_watershed)
+    if double_watershed == False:
+        result[result == 255] = 0
+        return {'double_watershed': False, 'droplet_count': result}
+    uniq_full, uniq_index, uniq_counts = np.unique(water, return_inverse=True, return_counts=True)
+    uniq_index = uniq_index.reshape(water.shape)
+    artefacts = _artefacts(uniq_full, uniq_index, np.flatnonzero(uniq_full)) if remove_artefacting else None
+    return {'double_watershed': True, 'uniq_full': uniq_full, 'uniq_index': uniq_index, 'uniq_counts': uniq_counts,
+            'artefacts': artefacts}
+
+
+def prefix_relabel(prefix, large_elements_pixels, pixel_diff, remove_artefacting):
+    '''
+    Cleans the elements of the first fold of watershed of a prefix, see segment_prefix and watershed_segment.
+
+    Outputs:
+    relabel                 := lookup table from the position of each index in uniq_full to its cleaned index, or None
+                               for single watershed. Parameter combinations with equal lookup tables and "drop_dilate"
+                               segment the image the same.
+    '''
+    if prefix['double_watershed'] == False:
+        return None
+    relabel = _clean_elements(prefix['uniq_full'], prefix['uniq_counts'], large_elements_pixels, pixel_diff, False)
+    if remove_artefacting:
+        if prefix['artefacts'] is None:
+            raise ValueError("Argument 'prefix' must be computed with 'remove_artefacting' to remove artefacting.")
+        relabel[prefix['artefacts']] = 0
+    return relabel
+
+
+def prefix_droplet_count(prefix, relabel, drop_dilate):
+    '''
+    Segments the image of a prefix with the cleaned indices of prefix_relabel, equal to the result of watershed_segment.
+    '''
+    if prefix['double_watershed'] == False:
+        return prefix['droplet_count'].copy()
+    water = relabel[prefix['uniq_index']] / 1.
+    kernel = np.ones((drop_dilate, drop_dilate), np.uint8)
+    return cv2.dilate(water, kernel, iterations=1)
+
+
+def _tiles(shape, tile_size, halo):
+    '''
+    Splits an image into square tiles that overlap their neighbours by a halo.
+
+    Inputs:
+    shape     := height and width of the image
+    tile_size := height and width of the tile cores, which partition the image
+    halo      := number of pixels each tile extends past its core on every side, clipped to the image
+
+    Outputs:
+    tiles     := list of (core, padded, inner) tuples, where core and padded are the (rows, cols) slices of the tile core
+                 and the tile with its halo in the image, and inner is the slice of the core within the padded tile
+    '''
+    height, width = shape[:2]
+    tiles = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            core = (slice(y, min(y + tile_size, height)), slice(x, min(x + tile_size, width)))
+            padded = (slice(max(y - halo, 0), min(y + tile_size + halo, height)),
+                      slice(max(x - halo, 0), min(x + tile_size + halo, width)))
+            inner = (slice(core[0].start - padded[0].start, core[0].stop - padded[0].start),
+                     slice(core[1].start - padded[1].start, core[1].stop - padded[1].start))
+            tiles.append((core, padded, inner))
+    return tiles
+
+
+def _otsu_threshold(hist):
+    '''
+    Computes Otsu's threshold from the 256-bin histogram of a grayscale image, exactly as cv2.threshold with
+    cv2.THRESH_OTSU does, so that the histogram can be accumulated tile by tile.
+    '''
+    scale = 1. / np.sum(hist)
+    mu = sum(i * float(h) for i, h in enumerate(hist)) * scale
+    mu1, q1 = 0., 0.
+    max_sigma, max_val = 0., 0
+    eps = np.finfo(np.float32).eps
+    for i, h in enumerate(hist):
+        p_i = float(h) * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1. - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1. - eps:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma, max_val = sigma, i
+    return max_val
+
+
+def _stitch_markers(mask, tile_size):
+    '''
+    Labels the connected regions of the watershed marker mask tile by tile and stitches the labels across tile seams,
+    numbering the regions in the same raster order as ndimage.label on the whole mask.
+
+    Inputs:
+    mask      := binary marker mask of the whole image
+    tile_size := height and width of the tiles
+
+    Outputs:
+    markers   := uint8 marker image of the first fold of watershed as computed by segment_on_dt before adding the
+                 borders, i.e., region k of ncc regions has value int(k * 255 / (ncc + 1))
+    '''
+    from scipy import sparse
+    from scipy.sparse import csgraph
+    tiles = _tiles(mask.shape, tile_size, 0)
+    width = mask.shape[1]
+    offsets, first, seams, pairs = {}, [np.zeros(1, np.int64)], {}, []
+    offset = 0
+    for core, _, _ in tiles:
+        y, x = core[0].start, core[1].start
+        lab, n = ndimage.label(mask[core])
+        uniq, index = np.unique(lab, return_index=True)
+        rows, cols = np.unravel_index(index[uniq > 0], lab.shape)
+        first.append((rows + y) * width + cols + x)  # first pixel of each region in raster order of the image
+        lab = np.where(lab > 0, lab + offset, 0)  # the regions of all tiles share one numbering
+        for key, seam, side in [((y - tile_size, x), 0, lab[0]), ((y, x - tile_size), 1, lab[:, 0])]:
+            if key in seams:  # 4-connected regions facing each other across a seam are the same region
+                touching = (seams[key][seam] > 0) & (side > 0)
+                pairs.append(np.stack((seams[key][seam][touching], side[touching])))
+        seams[y, x] = (lab[-1].copy(), lab[:, -1].copy())  # copies, as views would keep every tile's labels alive
+        offsets[y, x] = offset
+        offset += n
+    pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), np.int64)
+    graph = sparse.coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape=(offset + 1, offset + 1))
+    _, component = csgraph.connected_components(graph, directed=False)
+    first = np.concatenate(first)
+    component_first = np.full(component.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(component_first, component, first)  # a stitched region starts at the first pixel of its parts
+    component_first[component[0]] = -1  # background
+    rank = np.empty_like(component)
+    rank[np.argsort(component_first)] = np.arange(len(component_first))
+    ncc = len(component_first) - 1
+    values = (np.arange(ncc + 1) * (255 / (ncc + 1))).astype(np.int32)  # same scaling as segment_on_dt
+    lookup = values[rank[component]].astype(np.uint8)  # from the label of each tile region to its marker value
+    markers = np.zeros(mask.shape, np.uint8)
+    for core, _, _ in tiles:
+        lab, _ = ndimage.label(mask[core])
+        markers[core] = lookup[np.where(lab > 0, lab + offsets[core[0].start, core[1].start], 0)]
+    return markers
+
+
+@timed('watershed_segment_tiled')
+def watershed_segment_tiled(image, double_watershed, large_elements_pixels, pixel_diff, drop_dilate, plot_pixel_diff,
+                            remove_artefacting, tile_size=1024, halo=128):
+    '''
+    Applies watershed_segment tile by tile to reduce the memory of segmenting high-resolution images. Every step runs on
+    overlapping tiles and keeps only the tile cores, while the steps that depend on the whole image, i.e., Otsu's
+    threshold, the distance map scaling, the droplet indices, and the removal of large, small, and artefacting
+    elements, use statistics accumulated over all tiles. Droplets that cross a tile seam are stitched into one droplet.
+    The result equals that of watershed_segment as long as "halo" is at least one droplet diameter.
+
+    The float and int32 working arrays of every step are bounded by the tile and its halo, but the intermediate images
+    between steps are kept whole-frame as uint8, at most four at a time, i.e., about 4 bytes per pixel on top of the
+    input image, compared with 20 to 50 bytes per pixel for watershed_segment. With "remove_artefacting", 256 int32
+    chord profiles along each axis are added. Memory therefore still grows with the frame size, only by a smaller factor.
+    The halo of the distance map is doubled until it exceeds the largest distance of a droplet pixel to the background,
+    e.g., for single watershed of images with wide gaps between droplets, up to the whole frame, in which case the
+    distance map step holds whole-frame float32 arrays.
+
+    Inputs:
+    image                   := input droplet image to segment
+    double_watershed        := see watershed_segment
+    large_elements_pixels   := see watershed_segment
+    pixel_diff              := see watershed_segment
+    drop_dilate             := see watershed_segment
+    plot_pixel_diff         := see watershed_segment
+    remove_artefacting      := see watershed_segment
+    tile_size               := height and width of the tiles in pixels, which bounds the working arrays of each step
+    halo                    := number of pixels each tile overlaps its neighbours, at least one droplet diameter
+
+    Outputs:
+    droplet_count           := uint8 image of droplet interiors indexed by droplet number
+    '''
+    if double_watershed not in (True, False):
+        raise ValueError("Argument 'double_watershed' takes value either True or False.")
+    if halo < max(4, drop_dilate):
+        raise ValueError("Argument 'halo' takes value of at least 4 pixels and 'drop_dilate'.")
+    tiles = _tiles(image.shape, tile_size, halo)
+    gray = np.empty(image.shape[:2], np.uint8)
+    hist = np.zeros(256, np.int64)
+    for core, padded, inner in tiles:
+        img = image[padded]
+        if double_watershed == False:
+            img = 255 - img
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        gray[core] = cv2.medianBlur(img, 5)[inner]
+        hist += np.bincount(gray[core].ravel(), minlength=256)
+    threshold = _otsu_threshold(hist)  # Otsu's binarization over the histogram of all tiles
+
+    img_bin = np.empty_like(gray)
+    for core, padded, inner in tiles:
+        binary = np.where(gray[padded] > threshold, 255, 0).astype(np.uint8)
+        img_bin[core] = cv2.morphologyEx(binary, cv2.MORPH_OPEN, np.ones((4, 4), dtype=int))[inner]
+
+    # first fold of watershed, as in segment_on_dt
+    with stage('segment_on_dt', fold=1):
+        dt_halo = halo
+        while True:  # the distance map is scaled by its range over the whole image
+            tiles = _tiles(image.shape, tile_size, dt_halo)
+            dt_min, dt_max = np.float32(np.inf), np.float32(-np.inf)
+            for core, padded, inner in tiles:
+                dt = cv2.distanceTransform(img_bin[padded], 2, 3)[inner]
+                dt_min, dt_max = min(dt_min, dt.min()), max(dt_max, dt.max())
+            if dt_max < dt_halo or dt_halo >= max(image.shape[:2]):
+                break
+            dt_halo *= 2  # only distances that reach the halo may be cut short by the tile edge, so widen the halo
+        mask = np.empty_like(gray)
+        for core, padded, inner in tiles:
+            dt = cv2.distanceTransform(img_bin[padded], 2, 3)[inner]
+            mask[core] = ((dt - dt_min) / (dt_max - dt_min) * 255).astype(np.uint8) > 0
+        markers = _stitch_markers(mask, tile_size)
+        del mask
+        water = np.empty_like(gray)
+        for core, padded, inner in tiles:
+            border = cv2.dilate(img_bin[padded], None, iterations=1)
+            border = border - cv2.erode(border, None)
+            lbl = markers[padded].astype(np.int32)
+            lbl[border == 255] = 255
+            cv2.watershed(cv2.cvtColor(gray[padded], cv2.COLOR_GRAY2BGR), lbl)
+            lbl[lbl == -1] = 0
+            water[core] = lbl[inner]
+        del markers, img_bin, gray
+
+    if double_watershed == False:
+        result = 255 - water
+        result[result == 255] = 0
+        return result
+
+    counts = np.zeros(256, np.int64)
+    if remove_artefacting:
+        chords_v = np.zeros((256, water.shape[1]), np.int32)  # sum of the pixels of every index along x-axis
+        chords_h = np.zeros((256, water.shape[0]), np.int32)  # sum of the pixels of every index along y-axis
+    for core, padded, inner in tiles:
+        tile = water[core].astype(np.intp)
+        counts += np.bincount(tile.ravel(), minlength=256)
+        if remove_artefacting:
+            for chords, axis, span in [(chords_v, 0, core[1]), (chords_h, 1, core[0])]:
+                positions = np.indices(tile.shape)[1 - axis]
+                chords[:, span] += np.bincount((tile * tile.shape[1 - axis] + positions).ravel(),
+                                               minlength=256 * tile.shape[1 - axis]).reshape(256, -1)
+    uniq_full = np.flatnonzero(counts)
+    relabel = _clean_elements(uniq_full, counts[uniq_full], large_elements_pixels, pixel_diff, plot_pixel_diff)
+    if remove_artefacting:
+        for n in np.flatnonzero(relabel):
+            if _polymodal(chords_v[uniq_full[n]], chords_h[uniq_full[n]]):  # if the data is polymodal, remove the objects
+                relabel[n] = 0
+    lookup = np.zeros(256, np.uint8)
+    lookup[uniq_full] = relabel
+    kernel = np.ones((drop_dilate, drop_dilate), np.uint8)
+    droplet_count = np.empty_like(water)
+    for core, padded, inner in tiles:
+        droplet_count[core] = cv2.dilate(lookup[water[padded]], kernel, iterations=1)[inner]
+    return droplet_count
@@ -0,0 +1,156 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import itertools
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from crop import read_rotate_crop
+from pipeline import image_name
+from segmentation import segment_prefix, prefix_relabel, prefix_droplet_count, SegmentationError
+from loss import yield_loss, geometric_loss
+from instrument import stage
+
+SWEEP_PARAMS = ['double_watershed', 'large_elements_pixels', 'pixel_diff', 'drop_dilate', 'remove_artefacting']
+
+def _image_prefixes(path, params, modes, remove_artefacting):
+    '''
+    Reads, rotates, and crops an image, then computes its segmentation prefix for every value of "double_watershed".
+    '''
+    img = read_rotate_crop(img_path=path, rotate_crop_params=params['rotate_crop_params'],
+                           roi_only=params.get('roi_only', False))
+    with stage('segment_prefix', image=image_name(path)):
+        return {mode: segment_prefix(img, mode, remove_artefacting) for mode in modes}
+
+def _score_outcomes(prefix, outcomes, max_droplets, image):
+    '''
+    Segments an image prefix with each (relabel, drop_dilate) outcome and computes its losses.
+
+    Outputs:
+    scores        := list of (droplets, yield loss, geometric loss, total loss) tuples in the order of "outcomes"
+    '''
+    scores = []
+    for relabel, drop_dilate in outcomes:
+        droplet_count = prefix_droplet_count(prefix, relabel, drop_dilate)
+        yld_loss = yield_loss(droplet_count=droplet_count, max_droplets=max_droplets)
+        geom_loss, droplet_geometry = geometric_loss(droplet_count=droplet_count, image_name=image, iter_plot=False,
+                                                     columnar=True)
+        scores.append((len(droplet_geometry), yld_loss, geom_loss, (yld_loss + geom_loss) / 2))
+    return scores
+
+def sweep_segmentation(paths, grid, params, workers=1):
+    '''
+    Sweeps the segmentation parameters of watershed_segment over a grid. The steps that do not depend on the swept
+    parameters, i.e., reading, rotating and cropping, grayscale conversion, median blur, Otsu's binarization,
+    morphological opening, and the first fold of watershed, run once per image and value of "double_watershed". The
+    cleaned indices of each combination are computed from the element pixel counts of that prefix, and combinations
+    that clean the same elements with the same "drop_dilate" are segmented and scored once.
+
+    Inputs:
+    paths         := list of image paths
+    grid          := dictionary of parameter name to list of values, for any of "double_watershed",
+                     "large_elements_pixels", "pixel_diff", "drop_dilate", and "remove_artefacting"
+    params        := dictionary of crop, segmentation, and loss parameters, see pipeline.process_image. Parameters
+                     that are not in "grid" keep their value in "params".
+    workers       := number of worker processes computing the prefixes and scoring the combinations.
+                     If 1, everything runs in this process.
+
+    Outputs:
+    results       := dataframe of one row per image and combination with the parameter values, the number of
+                     droplets, and the yield, geometric, and total losses. Combinations for which watershed_segment
+                     raises, as too few elements remain to clean, obtain missing losses.
+    '''
+    import pandas as pd
+    unknown = set(grid) - set(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError(f"Argument 'grid' takes keys among {SWEEP_PARAMS}, not {sorted(unknown)}.")
+    names = list(grid)
+    combinations = [dict(params, **dict(zip(names, values))) for values in itertools.product(*grid.values())]
+    modes = sorted({combination['double_watershed'] for combination in combinations})
+    remove_artefacting = any(combination['remove_artefacting'] for combination in combinations)
+    rows = []
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        if executor is None:
+            prefixes = ((path, _image_prefixes(path, params, modes, remove_artefacting)) for path in paths)
+        else:
+            futures = {executor.submit(_image_prefixes, path, params, modes, remove_artefacting): path for path in paths}
+            prefixes = ((futures[future], future.result()) for future in as_completed(futures))
+        scoring = []  # (image, combinations with their outcome keys, distinct outcome keys, scores) per image and mode
+        for path, image_prefixes in prefixes:
+            image = image_name(path)
+            for mode, prefix in image_prefixes.items():
+                outcomes, keys = {}, []
+                for combination in combinations:
+                    if combination['double_watershed'] != mode:
+                        continue
+                    try:
+                        relabel = prefix_relabel(prefix, combination['large_elements_pixels'],
+                                                 combination['pixel_diff'], combination['remove_artefacting'])
+                    except SegmentationError:  # too few elements remain to clean, as watershed_segment would raise
+                        keys.append((combination, 'failed'))
+                        continue
+                    if relabel is None:  # single watershed does not depend on the other parameters
+                        key = None
+                    else:
+                        key = (relabel.tobytes(), combination['drop_dilate'])
+                    outcomes.setdefault(key, (relabel, combination['drop_dilate']))
+                    keys.append((combination, key))
+                unique = list(outcomes)
+                prefix = dict(prefix, artefacts=None)  # the workers only need the indexed image
+                chunks = [unique] if executor is None else [unique[i::workers] for i in range(min(workers, len(unique)))]
+                scores = []
+                for chunk in chunks:  # fan out the distinct outcomes of the image over the workers
+                    chunk_outcomes = [outcomes[key] for key in chunk]
+                    if executor is None:
+                        scores.append(_score_outcomes(prefix, chunk_outcomes, params['max_droplets'], image))
+                    else:
+                        scores.append(executor.submit(_score_outcomes, prefix, chunk_outcomes, params['max_droplets'],
+                                                      image))
+                scoring.append((image, keys, chunks, scores))
+        for image, keys, chunks, scores in scoring:
+            outcome_scores = {'failed': (0, np.nan, np.nan, np.nan)}
+            for chunk, chunk_scores in zip(chunks, scores):
+                outcome_scores.update(zip(chunk, chunk_scores if executor is None else chunk_scores.result()))
+            for combination, key in keys:
+                droplets, yld_loss, geom_loss, total_loss = outcome_scores[key]
+                rows.append(dict({'Image': image}, **{name: combination[name] for name in SWEEP_PARAMS},
+                                 Droplets=droplets, YieldLoss=yld_loss, GeomLoss=geom_loss, TotalLoss=total_loss))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweeps the segmentation parameters over a grid on droplet images.')
+    parser.add_argument('img_path', help='folder of droplet images')
+    parser.add_argument('params', help='json file of crop, segmentation, and loss parameters')
+    parser.add_argument('grid', help='json file of parameter name to list of values')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--csv', default=None, help='path to save the results as csv')
+    args = parser.parse_args()
+    with open(args.params) as f:
+        params = json.load(f)
+    with open(args.grid) as f:
+        grid = json.load(f)
+    paths = sorted(os.path.join(args.img_path, name) for name in os.listdir(args.img_path)
+                   if any(fmts in name for fmts in ['.jpg', '.png', '.jpeg']))
+    results = sweep_segmentation(paths, grid, params, workers=args.workers)
+    print(results.to_string(index=False))
+    if args.csv is not None:
+        results.to_csv(args.csv, index=False)
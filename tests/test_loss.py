@@ -0,0 +1,141 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Checks that geometric_loss returns exactly the losses and droplet geometry of its original implementation, which
+# binarized the whole image once per droplet, on synthetic and segmented droplet label images.
+
+import cv2 # pip install opencv-python          # https://pypi.org/project/opencv-python/
+import numpy as np
+import pytest
+from loss import geometric_loss
+from segmentation import watershed_segment
+from benchmarks.synthetic import droplet_tube
+
+def reference_geometric_loss(droplet_count, image_name):
+    '''
+    The original implementation of loss.geometric_loss, without plotting.
+    '''
+    loss_list = []
+    uniq_select = np.unique(droplet_count)
+    droplet_geometry = []
+    for n in range(len(uniq_select)):
+        if n == 0: # pass on background
+            pass
+        else:
+            uniq = uniq_select[n]
+            drops = droplet_count.copy()
+            drops[drops != uniq] = 0
+            drops[drops == uniq] = 1
+            circle_init = np.zeros(np.shape(drops))
+
+            # axis 1, summing each row
+            uniq_ax1 = np.sum(drops, axis=1)
+            start_ax1 = np.where(uniq_ax1 == uniq_ax1[uniq_ax1 > 0][0])[0][0]  # get the index of the first non-zero row value
+            mid_ax1 = start_ax1 + sum(np.sum(drops, axis=1) > 0) // 2  # sum only true values to find the length
+            diam_ax1 = (np.sum(drops, axis=1)[mid_ax1] + np.max(uniq_ax1)) / 2
+
+            # axis 0, summing each column
+            uniq_ax0 = np.sum(drops, axis=0)
+            start_ax0 = np.where(uniq_ax0 == uniq_ax0[uniq_ax0 > 0][0])[0][0]  # get the index of the first non-zero row value
+            mid_ax0 = start_ax0 + sum(np.sum(drops, axis=0) > 0) // 2  # sum only true values to find the length
+            diam_ax0 = (np.sum(drops, axis=0)[mid_ax0] + np.max(uniq_ax0)) / 2
+
+            radi = int((diam_ax0 / 2 + diam_ax1 / 2) / 2)
+
+            circ = cv2.circle(circle_init, (mid_ax0, mid_ax1), radi, (1, 1, 1), -1)
+            inside = drops + circ - 1
+            inside[inside < 0] = 0
+            total = np.abs(circ - drops) + inside
+
+            lossl = (np.sum(np.abs(circ - drops)) / np.sum(total)) * np.sum(drops)  # fraction of droplet not matching perfect circle weighted by the number of pixels in that droplet
+            loss_list.append(lossl)
+
+            droplet_geometry.append([image_name, n, mid_ax0, mid_ax1, diam_ax0, diam_ax1, np.sum(drops)])
+
+    total_pixels = np.sum(droplet_count != 0)  # total number of droplet pixels
+    geom_loss = np.sum(loss_list) / total_pixels
+    return geom_loss, droplet_geometry
+
+def random_labels(seed, dtype, negative=False, disconnected=False):
+    '''
+    Draws a label image of overlapping ellipses and rectangles, some touching the image border.
+
+    Inputs:
+    seed          := random seed
+    dtype         := label dtype
+    negative      := True or False value. If True, some droplets have negative labels.
+    disconnected  := True or False value. If True, some labels are reused by several separate droplets.
+
+    Outputs:
+    labels        := label image (height by width) with background 0
+    '''
+    rng = np.random.default_rng(seed)
+    height, width = rng.integers(20, 120, size=2)
+    labels = np.zeros((height, width), dtype=np.int32)
+    num_droplets = int(rng.integers(1, 12))
+    for label in range(1, num_droplets + 1):
+        if negative and rng.random() < 0.4:
+            label = -label
+        if disconnected and label > 2 and rng.random() < 0.4:
+            label = int(rng.integers(1, label))
+        cx, cy = int(rng.integers(-5, width + 5)), int(rng.integers(-5, height + 5))
+        rx, ry = int(rng.integers(1, 20)), int(rng.integers(1, 20))
+        if rng.random() < 0.7:
+            cv2.ellipse(labels, (cx, cy), (rx, ry), float(rng.uniform(0, 180)), 0, 360, label, -1)
+        else:
+            labels[max(cy - ry, 0):cy + ry, max(cx - rx, 0):cx + rx] = label
+    if dtype == np.uint8:
+        labels = np.abs(labels)
+    return labels.astype(dtype)
+
+def assert_matches_reference(droplet_count):
+    '''
+    Asserts that geometric_loss, in both output layouts, matches reference_geometric_loss exactly.
+    '''
+    geom_loss, droplet_geometry = geometric_loss(droplet_count, 'image', iter_plot=False)
+    ref_loss, ref_geometry = reference_geometric_loss(droplet_count, 'image')
+    np.testing.assert_equal(geom_loss, ref_loss)
+    assert droplet_geometry == ref_geometry
+
+    geom_loss, droplet_geometry = geometric_loss(droplet_count, 'image', iter_plot=False, columnar=True)
+    np.testing.assert_equal(geom_loss, ref_loss)
+    assert [list(record) for record in droplet_geometry.tolist()] == [geometry[1:] for geometry in ref_geometry]
+
+@pytest.mark.parametrize('dtype', [np.int32, np.float64, np.uint8])
+@pytest.mark.parametrize('seed', range(40))
+def test_random_labels(seed, dtype):
+    assert_matches_reference(random_labels(seed, dtype))
+
+@pytest.mark.parametrize('dtype', [np.int32, np.float64])
+@pytest.mark.parametrize('seed', range(20))
+def test_negative_labels(seed, dtype):
+    assert_matches_reference(random_labels(seed, dtype, negative=True))
+
+@pytest.mark.parametrize('seed', range(20))
+def test_disconnected_labels(seed):
+    assert_matches_reference(random_labels(seed, np.int32, disconnected=True))
+
+@pytest.mark.filterwarnings('ignore:invalid value encountered:RuntimeWarning')  # the loss of no droplets is 0 / 0
+def test_background_only():
+    assert_matches_reference(np.zeros((30, 40), dtype=np.int32))
+
+@pytest.mark.parametrize('double_watershed', [False, True])
+def test_segmented_tube(double_watershed):
+    image, _ = droplet_tube(400, 160, num_droplets=25, radius=14, deformation=0.2,
+                            style='ring' if double_watershed else 'solid', seed=1)
+    droplet_count = watershed_segment(image=image, double_watershed=double_watershed, large_elements_pixels=800,
+                                      pixel_diff=5, drop_dilate=3, plot_pixel_diff=False, remove_artefacting=False)
+    assert_matches_reference(droplet_count)
@@ -0,0 +1,174 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import json
+import logging
+import numpy as np
+import cv2 # pip install opencv-python          # https://pypi.org/project/opencv-python/
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from crop import rotate_crop
+from pipeline import score_image, failed_record
+from segmentation import SegmentationError
+from instrument import stage
+
+logger = logging.getLogger(__name__)
+
+def read_frames(video_path, start_s=0., end_s=None, stride=1, max_frames=None):
+    '''
+    Decodes the frames of a droplet video within a time window, without writing them to disk.
+
+    Inputs:
+    video_path    := video file path
+    start_s       := start time of the window in seconds
+    end_s         := end time of the window in seconds, exclusive. If None, reads until the end of the video.
+    stride        := keeps every "stride"-th frame of the window. Skipped frames are only grabbed, which skips their
+                     colour conversion and copy, but most codecs still decode them, so decoding time does not shrink
+                     with 1 / stride.
+    max_frames    := maximum number of frames kept. If None, keeps all frames of the window.
+
+    Outputs:
+    frames        := generator of (frame index, time in seconds, frame) tuples, where the frame has the channel order
+                     of cv2.imread, so it can be passed to rotate_crop as a read image
+    '''
+    if stride < 1:
+        raise ValueError("Argument 'stride' takes value of at least 1.")
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Argument 'video_path' takes value of a readable video file, not {video_path}.")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        index = int(round(start_s * fps))
+        stop = None if end_s is None else int(round(end_s * fps))
+        if index > 0:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+        first, kept = index, 0
+        while (stop is None or index < stop) and (max_frames is None or kept < max_frames):
+            with stage('video_decode'):
+                if (index - first) % stride:
+                    ok, frame = capture.grab(), None  # advances without converting or copying the frame
+                else:
+                    ok, frame = capture.read()
+            if not ok:  # end of the video
+                break
+            if frame is not None:
+                yield index, index / fps, frame
+                kept += 1
+            index += 1
+    finally:
+        capture.release()
+
+def score_frame(frame, name, params):
+    '''
+    Runs the crop -> segment -> loss chain on a decoded video frame. Frames that cannot be segmented, see
+    segmentation.SegmentationError, or have no droplets, e.g., while the condition is jetting, obtain the maximum total
+    loss of 1 like failed images.
+
+    Inputs:
+    frame         := decoded video frame, see read_frames
+    name          := frame name used in the droplet geometry
+    params        := dictionary of crop, segmentation, and loss parameters, see pipeline.process_image
+
+    Outputs:
+    record        := tuple of (frame name, yield loss, geometric loss, total loss, droplet geometry)
+    '''
+    with stage('process_image', image=name):
+        with stage('rotate_crop'):
+            img = rotate_crop(frame, params['rotate_crop_params'], params.get('roi_only', False))
+        try:
+            _, yld_loss, geom_loss, total_loss, droplet_geometry, _ = score_image(img, name, params)
+        except SegmentationError:
+            logger.exception("Scoring frame '%s' failed, so it is recorded as failed.", name)
+            return failed_record(name)
+    if total_loss != total_loss:  # no droplets, i.e., nan
+        total_loss = 1.
+    return name, yld_loss, geom_loss, total_loss, droplet_geometry
+
+def score_video(video_path, windows, params, stride=1, max_frames=None, workers=1):
+    '''
+    Scores every control parameter condition recorded in a droplet video by the losses of its sampled frames.
+
+    Inputs:
+    video_path    := video file path
+    windows       := list of (start, end) times in seconds of each condition in the video, in the order of the rows
+                     of the parameter csv file
+    params        := dictionary of crop, segmentation, and loss parameters, see pipeline.process_image
+    stride        := keeps every "stride"-th frame of each window, see read_frames
+    max_frames    := maximum number of frames scored per condition. If None, scores all sampled frames.
+    workers       := number of worker processes scoring frames. If 1, frames are scored in this process.
+
+    Outputs:
+    scores        := dataframe of one row per condition with the number of scored frames, the number of those that failed
+                     or have no droplets, see score_frame, the mean yield and geometric losses over the other frames,
+                     the mean total loss over all frames, and "TotalLossVar", the variance of the mean total loss,
+                     whose average can be passed as "noise_var" to BO_optimizer
+    frames        := dataframe of one row per scored frame with its condition, frame index, time, and losses
+    '''
+    import pandas as pd
+    records = []
+    pending = deque()  # frames being scored by the workers, oldest first
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for condition, (start_s, end_s) in enumerate(windows):
+            for index, time_s, frame in read_frames(video_path, start_s, end_s, stride, max_frames):
+                name = f'condition_{condition}_frame_{index}'
+                if executor is None:
+                    records.append((condition, index, time_s) + score_frame(frame, name, params)[1:4])
+                    continue
+                pending.append((condition, index, time_s, executor.submit(score_frame, frame, name, params)))
+                if len(pending) >= 4 * workers:  # bounds the decoded frames held in memory
+                    condition_done, index_done, time_done, future = pending.popleft()
+                    records.append((condition_done, index_done, time_done) + future.result()[1:4])
+        while pending:
+            condition_done, index_done, time_done, future = pending.popleft()
+            records.append((condition_done, index_done, time_done) + future.result()[1:4])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    frames = pd.DataFrame(records, columns=['Condition', 'Frame', 'Time', 'YieldLoss', 'GeomLoss', 'TotalLoss'])
+    grouped = frames.groupby('Condition')
+    droplets = frames[frames.GeomLoss.notna()].groupby('Condition')  # frames that did not fail and have droplets
+    count = grouped.TotalLoss.count()  # every frame has a total loss, failed frames 1
+    scores = pd.DataFrame({'Frames': count,
+                           'FailedFrames': count - droplets.size().reindex(count.index, fill_value=0),
+                           'YieldLoss': droplets.YieldLoss.mean(),
+                           'GeomLoss': droplets.GeomLoss.mean(),
+                           'TotalLoss': grouped.TotalLoss.mean(),
+                           'TotalLossVar': grouped.TotalLoss.var(ddof=1) / count})  # variance of the mean
+    scores = scores.reindex(np.arange(len(windows)))  # conditions without frames obtain missing losses
+    scores.index.name = 'Condition'
+    return scores, frames
+
+if __name__ == '__main__':
+    import pandas as pd
+    parser = argparse.ArgumentParser(description='Scores the control parameter conditions recorded in a droplet video.')
+    parser.add_argument('video_path', help='video file')
+    parser.add_argument('windows', help='csv file with "Start" and "End" columns, the times in seconds of each condition')
+    parser.add_argument('params', help='json file of crop, segmentation, and loss parameters')
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--csv', default=None, help='path to save the scores of each condition as csv')
+    args = parser.parse_args()
+    with open(args.params) as f:
+        params = json.load(f)
+    windows = pd.read_csv(args.windows)
+    scores, _ = score_video(args.video_path, list(zip(windows.Start, windows.End)), params, stride=args.stride,
+                            max_frames=args.max_frames, workers=args.workers)
+    print(scores.to_string())
+    if args.csv is not None:
+        scores.to_csv(args.csv)
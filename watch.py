@@ -0,0 +1,136 @@
+# Copyright (c) 2021 Alexander E. Siemenn, Iddo Drori, Matthew J. Beveridge
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice, this list of
+# conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation and/or other materials provided with the
+# distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE
+# GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT
+# OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from pipeline import image_name, process_image, collect_record
+from geometry import append_geometry
+
+IMAGE_FORMATS = ['.jpg', '.png', '.jpeg']
+
+def scan_images(img_path, sizes):
+    '''
+    Lists the droplet images in a folder that have finished being written.
+
+    Inputs:
+    img_path      := folder of droplet images
+    sizes         := dictionary of image path to file size at the previous scan; updated in place
+
+    Outputs:
+    ready         := list of image paths whose file size is unchanged since the previous scan
+    '''
+    ready = []
+    with os.scandir(img_path) as entries:
+        for entry in entries:
+            if not any(fmts in entry.name for fmts in IMAGE_FORMATS):
+                continue
+            size = entry.stat().st_size
+            if size > 0 and sizes.get(entry.path) == size:
+                ready.append(entry.path)
+            sizes[entry.path] = size
+    return ready
+
+def watch_folder(img_path, param_path, params, batch_size, workers=1, poll_interval=1., warm_start=True,
+                 model_type='GP', cache_dir=None, max_suggestions=None, geometry_dir=None):
+    '''
+    Runs the closed loop as a long-running service: scores droplet images as the camera writes them into "img_path" and
+    suggests the next batch of conditions with Bayesian optimization as soon as the last batch has been scored.
+
+    Inputs:
+    img_path          := folder the camera writes droplet images into
+    param_path        := parameter csv file, see BO_optimizer. Re-read whenever it changes, so rows for new images
+                         can be appended while the service runs. Images are only scored once listed in this file.
+    params            := dictionary of crop, segmentation, and loss parameters, see pipeline.process_image
+    batch_size        := number of conditions suggested per Bayesian optimization call
+    workers           := number of worker processes scoring images in the background
+    poll_interval     := seconds between scans of "img_path". Images are scored once their size is unchanged over one scan.
+    warm_start        := True or False value, see BO_optimizer
+    model_type        := 'GP' or 'sparseGP', see BO_optimizer
+    cache_dir         := directory of the on-disk result cache, see pipeline.process_image
+    max_suggestions   := number of Bayesian optimization calls after which the service stops. If None, runs until interrupted.
+    geometry_dir      := directory of the droplet geometry dataset, see geometry.py. If given, the droplet geometry of every
+                         scored image is appended to it, partitioned by the number of suggestions made before the image
+                         was scored. If None, droplet geometry is not kept.
+
+    Outputs:
+    Writes "bo_predicted_params.csv" next to "param_path" after every batch of scored images. Images that cannot be
+    segmented or have no droplets, e.g., blank or jetting images, obtain the maximum total loss of 1 like failed images,
+    see pipeline.collect_record.
+    '''
+    import pandas as pd
+    from bo import BO_optimizer
+    sizes = {}  # file sizes at the previous scan
+    submitted = set()  # names of images queued or scored
+    losses = {}  # total loss of each scored image
+    pending = {}  # image path of each future in flight
+    param_mtime = None
+    scored_at_last_suggestion = None
+    suggestions = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while max_suggestions is None or suggestions < max_suggestions:
+            if os.path.getmtime(param_path) != param_mtime:
+                param_mtime = os.path.getmtime(param_path)
+                data = pd.read_csv(param_path)  # read parameter csv file into df
+                failed = dict(zip(data.Image, data.Failed))
+            for path in scan_images(img_path, sizes):
+                name = image_name(path)
+                if name in failed and name not in submitted:
+                    submitted.add(name)
+                    best_loss = min(losses.values(), default=None)
+                    future = executor.submit(process_image, path, params, failed[name], cache_dir, None, best_loss)
+                    pending[future] = path
+            done, _ = wait(pending, timeout=0)
+            for future in done:
+                image, yld_loss, geom_loss, total_loss, droplet_geometry = collect_record(future, pending.pop(future))
+                losses[image] = 1. if total_loss != total_loss else total_loss  # no droplets, i.e., nan, is the maximum loss
+                if geometry_dir is not None:
+                    append_geometry(geometry_dir, droplet_geometry, image, iteration=suggestions)
+
+            # suggest once every listed image is scored and a full batch is new since the last suggestion
+            if all(name in losses for name in data.Image) and (
+                    scored_at_last_suggestion is None or len(losses) - scored_at_last_suggestion >= batch_size):
+                scored = data.copy()
+                scored['ImageArray'] = None  # keeps the column layout expected by BO_optimizer
+                scored['TotalLoss'] = [losses[name] for name in scored.Image]
+                BO_optimizer(data=scored, batch_size=batch_size, param_path=param_path, save=True,
+                             warm_start=warm_start, model_type=model_type)
+                scored_at_last_suggestion = len(losses)
+                suggestions += 1
+                continue
+            time.sleep(poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scores droplet images as they are written and suggests new conditions.')
+    parser.add_argument('img_path', help='folder the camera writes droplet images into')
+    parser.add_argument('param_path', help='parameter csv file')
+    parser.add_argument('params', help='json file of crop, segmentation, and loss parameters')
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--poll-interval', type=float, default=1.)
+    parser.add_argument('--model-type', default='GP', choices=['GP', 'sparseGP'])
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--geometry-dir', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.params) as f:
+        params = json.load(f)
+    watch_folder(args.img_path, args.param_path, params, args.batch_size, workers=args.workers,
+                 poll_interval=args.poll_interval, model_type=args.model_type, cache_dir=args.cache_dir,
+                 geometry_dir=args.geometry_dir)